@@ -2,6 +2,11 @@ import numpy as onp
 # import jax.numpy as jnp
 import scipy
 import multiprocessing
+import os
+import tempfile
+import hashlib
+import pickle
+import weakref
 from functools import reduce
 from itertools import repeat
 import pdb
@@ -24,19 +29,100 @@ def diagMatrix(z):
     onp.fill_diagonal(diag_z,z)
     return(diag_z)
 
-def geweke_functions(samples):
+def secondMomentIndices(p, moments='all', indices=None):
+    '''
+    Column pairs (i, j) of the second moments used by `geweke_functions` for samples of dimension `p`, as two index vectors
+    `moments` = 'all' (every pair with j <= i, in row-major order), 'diagonal' (squares only) or 'first' (no second moments)
+    `indices` = optional (k x 2) array of (i, j) pairs that overrides `moments`
+    '''
+    if indices is not None:
+        indices = onp.asarray(indices, dtype='int').reshape(-1, 2)
+        return indices[:, 0], indices[:, 1]
+    assert moments in ['all', 'diagonal', 'first']
+    if moments == 'all':
+        return onp.tril_indices(p)
+    elif moments == 'diagonal':
+        return onp.arange(p), onp.arange(p)
+    else:
+        return onp.zeros(0, dtype='int'), onp.zeros(0, dtype='int')
+
+def geweke_functions(samples, moments='all', indices=None, dtype=None, block_size=256):
     '''
     Returns a matrix with column means corresponding to the first and second empirical moments of `samples`.
+    `moments` = 'all', 'diagonal' or 'first', or `indices` = (k x 2) array of (i, j) pairs, selects the second moments (see `secondMomentIndices`)
+    `dtype` = dtype of the output (default float64). Second moments are filled `block_size` columns at a time
     '''
-    f1 = samples.copy()
-    n, p = f1.shape
-    f2 = onp.empty([n, int(p*(p+1)/2)])
-    counter = 0
-    for i in range(p):
-        for j in range(i+1):
-            f2[:, counter] = f1[:, i] * f1[:, j]
-            counter += 1
-    return onp.hstack([f1, f2])
+    n, p = samples.shape
+    if dtype is None:
+        dtype = onp.float64
+    I, J = secondMomentIndices(p, moments=moments, indices=indices)
+    k = len(I)
+    out = onp.empty([n, p + k], dtype=dtype)
+    out[:, :p] = samples
+    for start in range(0, k, block_size):
+        end = min(start + block_size, k)
+        onp.multiply(samples[:, I[start:end]], samples[:, J[start:end]], out=out[:, (p+start):(p+end)])
+    return out
+
+class geweke_function_view(object):
+    def __init__(self, samples, moments='all', indices=None, dtype=None, block_size=256):
+        '''
+        Lazy version of `geweke_functions(samples, ...)`: columns are computed on demand, so the second moments need not all be held in memory
+        Consumers read it `block_size` columns at a time with `iter_blocks`; `onp.asarray` materializes the full matrix
+        '''
+        assert len(samples.shape) == 2
+        self._samples = samples
+        self._moments = moments
+        self._indices = indices
+        self._I, self._J = secondMomentIndices(samples.shape[1], moments=moments, indices=indices)
+        self._dtype = onp.float64 if dtype is None else dtype
+        self._block_size = int(block_size)
+        pass
+
+    @property
+    def shape(self):
+        n, p = self._samples.shape
+        return (n, p + len(self._I))
+
+    @property
+    def block_size(self):
+        return self._block_size
+
+    def columns(self, cols):
+        '''
+        Compute the test function columns with indices `cols`
+        '''
+        cols = onp.asarray(cols, dtype='int')
+        p = self._samples.shape[1]
+        out = onp.empty([self._samples.shape[0], len(cols)], dtype=self._dtype)
+        first = cols < p
+        out[:, first] = self._samples[:, cols[first]]
+        second = cols[~first] - p
+        out[:, ~first] = self._samples[:, self._I[second]] * self._samples[:, self._J[second]]
+        return out
+
+    def iter_blocks(self, block_size=None):
+        '''
+        Yield the test function matrix in consecutive blocks of `block_size` columns
+        '''
+        if block_size is None:
+            block_size = self._block_size
+        num_cols = self.shape[1]
+        for start in range(0, num_cols, block_size):
+            yield self.columns(onp.arange(start, min(start + block_size, num_cols)))
+
+    def __getitem__(self, rows):
+        # Row selection (e.g. thinning) returns a view on the selected samples
+        if isinstance(rows, tuple):
+            rows, cols = rows
+            assert cols == slice(None)
+        return geweke_function_view(self._samples[rows, :], moments=self._moments, indices=self._indices, dtype=self._dtype, block_size=self._block_size)
+
+    def __array__(self, dtype=None, copy=None):
+        out = self.columns(onp.arange(self.shape[1]))
+        if dtype is not None:
+            out = out.astype(dtype)
+        return out
 
 def GaussianProductMV(mu_0, Sigma_0, lst_mu, lst_Sigma):
     '''
@@ -74,12 +160,90 @@ def splitIter(num_iter, nproc):
         arr_iter[i] += 1
     return arr_iter
 
+def sampleBuffer(path, num_rows, num_cols, row_offset=0):
+    '''
+    Memory-map rows [`row_offset`, `row_offset`+`num_rows`) of the (? x `num_cols`) float64 sample buffer stored at `path`
+    '''
+    return onp.memmap(path, dtype=onp.float64, mode='r+', offset=int(row_offset)*int(num_cols)*8, shape=(int(num_rows), int(num_cols)))
+
+def reserveBuffer(num_bytes, buffer_dir=None):
+    '''
+    Create a temporary file holding `num_bytes` bytes for a shared sample buffer and return its path
+    The file is placed in `buffer_dir` if given, else in /dev/shm if it has room, else in the system temporary directory
+    Its space is reserved up front, so a full file system raises OSError here instead of killing the workers with SIGBUS when they write
+    '''
+    if buffer_dir is not None:
+        candidates = [buffer_dir]
+    elif os.path.isdir('/dev/shm'):
+        candidates = ['/dev/shm', tempfile.gettempdir()]
+    else:
+        candidates = [tempfile.gettempdir()]
+    for i, directory in enumerate(candidates):
+        last = i == len(candidates) - 1
+        if hasattr(os, 'statvfs') and last == False:
+            st = os.statvfs(directory)
+            if st.f_bavail * st.f_frsize < num_bytes:
+                continue
+        fd, path = tempfile.mkstemp(prefix='mcmcmd_', suffix='.dat', dir=directory)
+        try:
+            if hasattr(os, 'posix_fallocate'):
+                os.posix_fallocate(fd, 0, num_bytes)
+            else:
+                os.ftruncate(fd, num_bytes)
+        except OSError:
+            os.close(fd)
+            os.remove(path)
+            if last == True:
+                raise
+            continue
+        os.close(fd)
+        return path
+
+# Model copy held by each worker process of a sampler's pool; shipped once by the pool initializer
+_worker_model = None
+
+def _init_worker(model_bytes):
+    global _worker_model
+    _worker_model = pickle.loads(model_bytes)
+
+def _terminate_pool(pool):
+    pool.terminate()
+    pass
+
+# Attributes that don't make the workers' copy of a model stale: the pool itself, and the random number generators, which are sent with each task
+POOL_STATE_EXCLUDED = ['_pool', '_pool_finalizer', '_pool_fingerprint', '_seed_sequence', '_bitgen_m', '_rng_m', '_bitgen_s', '_rng_s']
+
+def _worker_forward(path, row_offset, num_samples, rng):
+    if num_samples > 0:
+        out = sampleBuffer(path, num_samples, _worker_model.sample_dim, row_offset)
+        _worker_model.forward(num_samples, rng, out=out)
+        out.flush()
+    pass
+
+def _worker_successive(path, row_offset, num_samples, rng):
+    if num_samples > 0:
+        out = sampleBuffer(path, num_samples, _worker_model.sample_dim, row_offset)
+        _worker_model.successive(num_samples, rng, out=out)
+        out.flush()
+    pass
+
+def _worker_backward(path, row_offset, num_samples, burn_in_samples, rng):
+    if num_samples > 0:
+        out = sampleBuffer(path, num_samples, _worker_model.sample_dim, row_offset)
+        _worker_model.backward(num_samples, burn_in_samples, rng, out=out)
+        out.flush()
+    pass
+
 class model_sampler(object):
     def __init__(self, **kwargs):
         '''
         Generic sampler class
         '''
         self._nproc = 1
+        self._pool = None
+        self._pool_finalizer = None
+        self._pool_fingerprint = None
+        self._buffer_dir = None
         for key, value in kwargs.items():
             setattr(self, '_' + key, value)
         if hasattr(self, '_seed'):
@@ -120,6 +284,26 @@ class model_sampler(object):
         Draw from P(Theta|Y) via MCMC
         '''
         pass
+
+    def drawPriorBatch(self, num_samples, rng):
+        '''
+        Optional: draw `num_samples` independent rows from P(Theta); returns a (num_samples x dim(Theta)) array
+        '''
+        pass
+
+    def drawLikelihoodBatch(self, theta, rng):
+        '''
+        Optional: draw one Y from P(Y|Theta) for each row of `theta`; returns a (num_samples x dim(Y)) array
+        '''
+        pass
+
+    @property
+    def has_batch(self):
+        '''
+        True if the subclass implements both `drawPriorBatch` and `drawLikelihoodBatch`
+        '''
+        cls = type(self)
+        return (cls.drawPriorBatch is not model_sampler.drawPriorBatch) and (cls.drawLikelihoodBatch is not model_sampler.drawLikelihoodBatch)
     
     def set_seed(self, seed=None):
         '''
@@ -137,9 +321,72 @@ class model_sampler(object):
         '''
         Set number of parallel processes used for sampling
         '''
+        if nproc != self._nproc:
+            self.close_pool()
         self._nproc = nproc
         self.init_rng()
         pass
+
+    def start_pool(self):
+        '''
+        Start the worker pool used by `sample_mc` and `sample_bc` if it is not already running, and return it
+        The model is pickled to each worker once, when the pool starts. If the model's attributes have changed since, the pool is restarted so that the workers pick up the change
+        The pool is terminated when the model is garbage collected, if it wasn't closed with `close_pool` before
+        '''
+        if self._nproc == 1:
+            return self._pool
+        fingerprint = self._state_fingerprint()
+        if self._pool is not None and fingerprint != self._pool_fingerprint:
+            # The workers hold a stale copy of the model
+            self.close_pool()
+        if self._pool is None:
+            # The workers get the model as bytes, so that the pool doesn't keep the model alive
+            self._pool = multiprocessing.Pool(processes=self._nproc, initializer=_init_worker, initargs=(pickle.dumps(self),))
+            self._pool_finalizer = weakref.finalize(self, _terminate_pool, self._pool)
+            self._pool_fingerprint = fingerprint
+        return self._pool
+
+    def close_pool(self):
+        '''
+        Shut down the worker pool, if any
+        '''
+        if getattr(self, '_pool', None) is not None:
+            self._pool_finalizer.detach()
+            self._pool.close()
+            self._pool.join()
+            self._pool = None
+        pass
+
+    def terminate_pool(self):
+        '''
+        Terminate the worker pool, if any, without waiting for outstanding work
+        '''
+        if getattr(self, '_pool', None) is not None:
+            self._pool_finalizer()
+            self._pool = None
+        pass
+
+    def _state_fingerprint(self):
+        # Hash of the model state the workers depend on (see `POOL_STATE_EXCLUDED`)
+        state = self.__getstate__()
+        state = {key: value for key, value in state.items() if key not in POOL_STATE_EXCLUDED}
+        return hashlib.sha1(pickle.dumps(state)).hexdigest()
+
+    def __enter__(self):
+        self.start_pool()
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close_pool()
+        pass
+
+    def __getstate__(self):
+        # The pool can't be pickled; workers get a copy of the model without it
+        state = self.__dict__.copy()
+        state['_pool'] = None
+        state['_pool_finalizer'] = None
+        state['_pool_fingerprint'] = None
+        return state
     
     def init_rng(self):
         '''
@@ -170,34 +417,47 @@ class model_sampler(object):
             raise ValueError
         pass
     
-    def forward(self, num_samples, rng):
+    def forward(self, num_samples, rng, out=None):
         '''
         Algorithm 1: marginal-conditional simulator
-        '''
-        samples = onp.empty([num_samples, self.sample_dim])
+        Uses the batched draws `drawPriorBatch`/`drawLikelihoodBatch` if the subclass implements them
+        Samples are written into `out` if given
+        '''
+        samples = onp.empty([num_samples, self.sample_dim]) if out is None else out
+        if self.has_batch:
+            sample_prior = onp.asarray(self.drawPriorBatch(num_samples, rng)).reshape(num_samples, -1)
+            sample_likelihood = onp.asarray(self.drawLikelihoodBatch(sample_prior, rng)).reshape(num_samples, -1)
+            dim_likelihood = sample_likelihood.shape[1]
+            samples[:, :dim_likelihood] = sample_likelihood
+            samples[:, dim_likelihood:] = sample_prior
+            return samples
         for i in range(num_samples):
             sample_prior = self.drawPrior(rng)
             sample_likelihood = self.drawLikelihood(rng)
             samples[i, :] = onp.hstack([sample_likelihood, sample_prior])
         return samples
 
-    def successive(self, num_samples, rng):
+    def successive(self, num_samples, rng, out=None, restart=True):
         '''
         Algorithm 2: successive-conditional simulator
+        Samples are written into `out` if given
+        If `restart`=False, continues the chain from the current state instead of drawing a new initial state from the prior
         '''
-        samples = onp.empty([int(num_samples), self.sample_dim])
-        self.drawPrior(rng)
+        samples = onp.empty([int(num_samples), self.sample_dim]) if out is None else out
+        if restart == True:
+            self.drawPrior(rng)
         for i in range(int(num_samples)):
             sample_likelihood = self.drawLikelihood(rng)
             sample_posterior = self.drawPosterior(rng)
             samples[i, :] = onp.hstack([sample_likelihood, sample_posterior])
         return samples  
     
-    def backward(self, num_samples, burn_in_samples, rng):
+    def backward(self, num_samples, burn_in_samples, rng, out=None):
         '''
         Algorithm 3: backward-conditional simulator
+        Samples are written into `out` if given
         '''
-        samples = onp.empty([num_samples, self.sample_dim])
+        samples = onp.empty([num_samples, self.sample_dim]) if out is None else out
         for i in range(int(num_samples)):
             self.drawPrior(rng)
             sample_likelihood = self.drawLikelihood(rng)
@@ -206,45 +466,105 @@ class model_sampler(object):
             samples[i, :] = onp.hstack([sample_likelihood, sample_posterior])
         return samples
     
+    def sample_parallel(self, worker, num_samples, *args):
+        '''
+        Run `worker` on the pool with the per-process random number generators, splitting `num_samples` rows across processes
+        Each worker writes its rows directly into a shared memory-mapped buffer (see `reserveBuffer`), so the returned array is not copied
+        If a worker process dies, the pool is terminated and RuntimeError is raised
+        '''
+        num_cols = self.sample_dim
+        if num_samples == 0:
+            return onp.empty([0, num_cols])
+        lst_num_samples = splitIter(num_samples, self._nproc)
+        lst_row_offset = onp.cumsum(lst_num_samples) - lst_num_samples
+        path = reserveBuffer(num_samples*num_cols*8, self._buffer_dir)
+        try:
+            pool = self.start_pool()
+            # The pool silently replaces dead workers and their tasks never complete, so watch the original processes
+            processes = list(pool._pool)
+            result = pool.starmap_async(worker, zip(repeat(path), lst_row_offset, lst_num_samples, *[repeat(a) for a in args], self._rng_m))
+            while result.ready() == False:
+                result.wait(0.1)
+                if result.ready() == False and any([p.exitcode is not None for p in processes]):
+                    self.terminate_pool()
+                    raise RuntimeError('a sampling worker process died')
+            result.get()
+            # The mapping stays valid after the file is removed
+            samples = onp.asarray(sampleBuffer(path, num_samples, num_cols))
+        finally:
+            os.remove(path)
+        return samples
+
     def sample_mc(self, num_samples):
         '''
         Parallelized wrapper for Algorithm 1: marginal-conditional simulator
+        Reuses the sampler's worker pool across calls; see `start_pool` and `close_pool`
         '''
         if self._nproc == 1:
             samples = self.forward(int(num_samples), self._rng_s)
         else:
-            lst_num_samples = splitIter(int(num_samples), self._nproc)
-            pool = multiprocessing.Pool(processes=self._nproc)
-            out = pool.starmap(self.forward, zip(lst_num_samples, self._rng_m))
-            pool.close()
-            samples = onp.vstack(out)
+            samples = self.sample_parallel(_worker_forward, int(num_samples))
             self.jump_rng('m')
         return samples
 
-    def sample_sc(self, num_samples):
+    def sample_sc(self, num_samples, multi_chain=False):
         '''
         Wrapper for Algorithm 2: successive-conditional simulator
-        '''      
-        samples = self.successive(int(num_samples), self._rng_s)
-        return samples
+        If `multi_chain`=True, runs `nproc` independent chains in parallel on the multi-process random number generators, splitting `num_samples` between them, and returns the stacked samples together with a vector of chain ids
+        '''
+        if multi_chain == False:
+            samples = self.successive(int(num_samples), self._rng_s)
+            return samples
+        lst_num_samples = splitIter(int(num_samples), self._nproc)
+        if self._nproc == 1:
+            samples = self.successive(int(num_samples), self._rng_m[0])
+        else:
+            samples = self.sample_parallel(_worker_successive, int(num_samples))
+        self.jump_rng('m')
+        chain_ids = onp.repeat(onp.arange(self._nproc), lst_num_samples)
+        return samples, chain_ids
 
     def sample_bc(self, num_samples, burn_in_samples):
         '''
         Parallelized wrapper for Algorithm 3: backward-conditional simulator
+        Reuses the sampler's worker pool across calls; see `start_pool` and `close_pool`
         '''
         if self._nproc == 1:
             samples = self.backward(int(num_samples), int(burn_in_samples), self._rng_s)
         else:    
-            lst_num_samples = splitIter(int(num_samples), self._nproc)
-            pool = multiprocessing.Pool(processes=self._nproc)
-            out = pool.starmap(self.backward, zip(lst_num_samples, repeat(burn_in_samples), self._rng_m))
-            pool.close()
-            samples = onp.vstack(out)
+            samples = self.sample_parallel(_worker_backward, int(num_samples), int(burn_in_samples))
             self.jump_rng('m')
         return samples
 
-    def test_functions(self, samples):
+    def iter_mc(self, num_samples, chunk_size):
+        '''
+        Generator version of `sample_mc`; yields `num_samples` samples in chunks of at most `chunk_size` rows
+        '''
+        num_samples = int(num_samples)
+        for start in range(0, num_samples, int(chunk_size)):
+            yield self.sample_mc(min(int(chunk_size), num_samples - start))
+
+    def iter_sc(self, num_samples, chunk_size):
+        '''
+        Generator version of `sample_sc`; yields a single chain of `num_samples` samples in chunks of at most `chunk_size` rows
+        '''
+        num_samples = int(num_samples)
+        for start in range(0, num_samples, int(chunk_size)):
+            yield self.successive(min(int(chunk_size), num_samples - start), self._rng_s, restart=(start == 0))
+
+    def iter_bc(self, num_samples, burn_in_samples, chunk_size):
+        '''
+        Generator version of `sample_bc`; yields `num_samples` samples in chunks of at most `chunk_size` rows
+        '''
+        num_samples = int(num_samples)
+        for start in range(0, num_samples, int(chunk_size)):
+            yield self.sample_bc(min(int(chunk_size), num_samples - start), burn_in_samples)
+
+    def test_functions(self, samples, lazy=False, **kwargs):
         '''
-        Test functions computed on (Y, Theta)
+        Test functions computed on (Y, Theta); `kwargs` are passed to `geweke_functions`
+        If `lazy`=True, returns a `geweke_function_view` that computes the columns on demand
         '''
-        return geweke_functions(samples)
\ No newline at end of file
+        if lazy == True:
+            return geweke_function_view(samples, **kwargs)
+        return geweke_functions(samples, **kwargs)
\ No newline at end of file
@@ -2,9 +2,18 @@ import multiprocessing
 import numpy as onp
 from matplotlib import pyplot as plt
 import scipy
-import arch.covariance.kernel
+import scipy.fft
+import scipy.signal
+try:
+    import arch.covariance.kernel
+except ImportError:
+    arch = None
 import os
+import tempfile
 import pickle
+import hashlib
+import copy
+from collections import OrderedDict
 from time import perf_counter
 
 def splitIter(num_iter, nproc):
@@ -16,25 +25,284 @@ def splitIter(num_iter, nproc):
         arr_iter[i] += 1
     return arr_iter
 
-def normalizeTwoSamples(X, Y):
+def spawnRngs(rng, num):
+    '''
+    `num` independent child random number generators, seeded from a single draw of `rng`
+    '''
+    seeds = onp.random.SeedSequence(int(rng.integers(2**63))).spawn(num)
+    return [onp.random.default_rng(seed) for seed in seeds]
+
+# Default number of replicates per chunk (see `mapChunks`)
+MAP_CHUNK_SIZE = 50
+
+def _runChunk(task):
+    f, num, rng, args = task
+    return f(num, rng, *args)
+
+def mapChunks(f, num_samples, chunk_size, rng, args=(), executor=None, f_stacked=None):
+    '''
+    Compute `num_samples` replicates as f(num, rng_chunk, *`args`) over chunks of at most `chunk_size` (default `MAP_CHUNK_SIZE`) replicates, each chunk with its own child random number generator (see `spawnRngs`), and concatenate the returned arrays
+    `executor` optionally runs the chunks in parallel: any object with a `map` method, e.g. `concurrent.futures.ThreadPoolExecutor` (for BLAS-bound work; memory is shared) or `concurrent.futures.ProcessPoolExecutor`/`multiprocessing.Pool` (`f` and `args` must be picklable)
+    Without an executor, `f_stacked`(lst_num, lst_rng, *`args`) optionally computes all chunks in one call, e.g. to share passes over a kernel matrix (see `mmdPermutationNull`); it must return what the chunks would, concatenated
+    The chunks and their seeds don't depend on the executor, so the result is the same for any number of workers (up to the rounding of matrix products of different widths in `f_stacked`)
+    '''
+    if chunk_size is None:
+        chunk_size = MAP_CHUNK_SIZE
+    chunk_size = int(chunk_size)
+    lst_num = [min(chunk_size, num_samples - start) for start in range(0, num_samples, chunk_size)]
+    lst_rng = spawnRngs(rng, len(lst_num))
+    if executor is None and f_stacked is not None:
+        return f_stacked(lst_num, lst_rng, *args)
+    tasks = [(f, num, rng_chunk, args) for num, rng_chunk in zip(lst_num, lst_rng)]
+    if executor is None:
+        results = list(map(_runChunk, tasks))
+    else:
+        results = list(executor.map(_runChunk, tasks))
+    return onp.concatenate(results, axis=0)
+
+def normalizeTwoSamples(X, Y, dtype=None):
     '''
     Normalize feature scales of two samples `X` and `Y` by dividing by the pooled standard deviations of the features
+    The standard deviations are computed in double precision; the normalized samples are returned in `dtype` if given
     '''
     assert len(X.shape) == 2 and len(Y.shape) == 2
     assert X.shape[1] == Y.shape[1]
     XY = onp.vstack([X, Y])
-    std = onp.std(XY, axis=0)
+    std = onp.std(XY, axis=0, dtype=onp.float64)
     if (std==0).sum() > 0:
         std[std==0]=1
     X_tilde = X/std.reshape(1, X.shape[1])
     Y_tilde = Y/std.reshape(1, Y.shape[1])
+    if dtype is not None:
+        X_tilde = X_tilde.astype(dtype)
+        Y_tilde = Y_tilde.astype(dtype)
     return X_tilde, Y_tilde
 
+def multipleTestCorrection(p_value, alpha, test_correction):
+    '''
+    Reject the hypotheses with p-values `p_value` at level `alpha` after correcting for multiple testing, with `test_correction` set to 'b' (for Bonferroni) or 'bh' (for Benjamini-Hochberg)
+    Returns the vector of rejections and the (asymptotic, Bonferroni only) critical value of a two-sided z-test
+    '''
+    assert test_correction in ['b', 'bh']
+    num_tests = len(p_value)
+    if test_correction == 'b':
+        threshold = scipy.stats.norm.ppf(1.-alpha/(2.)) # asymptotic
+        alpha /= num_tests
+        result = p_value <= alpha
+    elif test_correction == 'bh':
+        threshold = None
+        rank = onp.empty_like(p_value)
+        rank[onp.argsort(p_value)] = onp.arange(1, len(p_value)+1)
+        under = p_value <= rank/num_tests * alpha
+        if under.sum() > 0:
+            rank_max = rank[under].max()
+        else:
+            rank_max = 0
+        result = rank <= rank_max
+    return result, threshold
+
+def iterColumnBlocks(g):
+    '''
+    Iterate over column blocks of `g`, either an array (a single block) or a lazy test function view such as `geweke_function_view` (blocks of its `block_size` columns)
+    '''
+    if hasattr(g, 'iter_blocks'):
+        for block in g.iter_blocks():
+            yield block
+    else:
+        yield g
+
+def columnBlock(g, start, end):
+    '''
+    Columns `start`, ..., `end`-1 of `g`, either an array or a lazy test function view
+    '''
+    if hasattr(g, 'columns'):
+        return g.columns(onp.arange(start, end))
+    return g[:, start:end]
+
+def iterPairedColumnBlocks(X, Y):
+    '''
+    Iterate over pairs of matching column blocks of `X` and `Y`, each either an array or a lazy test function view (see `iterColumnBlocks`)
+    The columns are split by the block size of `X` if it is a view, else that of `Y`, and both are read over the same column ranges
+    '''
+    assert X.shape[1] == Y.shape[1]
+    p = X.shape[1]
+    block_size = getattr(X, 'block_size', None)
+    if block_size is None:
+        block_size = getattr(Y, 'block_size', None)
+    if block_size is None:
+        block_size = max(p, 1)
+    for start in range(0, p, block_size):
+        end = min(start + block_size, p)
+        yield columnBlock(X, start, end), columnBlock(Y, start, end)
+
 #######################################################################
 ############################# Kernels #################################
 #######################################################################
 
+# Working memory (in bytes) of one row block of a pairwise matrix
+PAIRWISE_MAX_BYTES = 2**26
+
+# Number of entries read at a time from packed kernel matrices (see `pooled_gram_matrix`)
+PACKED_BAND_ENTRIES = 2**15
+
+def pairwiseRowBlocks(n_X, n_Y, max_bytes=None):
+    '''
+    Split the rows of an (n_X x n_Y) pairwise matrix into slices of about `max_bytes` each
+    '''
+    if max_bytes is None:
+        max_bytes = PAIRWISE_MAX_BYTES
+    block_size = max(1, int(max_bytes // (8 * max(n_Y, 1))))
+    for start in range(0, n_X, block_size):
+        yield slice(start, min(start + block_size, n_X))
+
+def pairwiseInner(X, Y, out=None, transform=None, max_bytes=None):
+    '''
+    Matrix of inner products <x_i, y_j> of the rows of `X` and `Y`, computed in row blocks, in single precision if both are float32 and double otherwise
+    `transform` is optionally applied in place to each block, e.g. to turn it into a kernel matrix
+    '''
+    n_X, n_Y = X.shape[0], Y.shape[0]
+    if out is None:
+        out = onp.empty([n_X, n_Y], dtype=onp.result_type(X, Y, onp.float32))
+    for rows in pairwiseRowBlocks(n_X, n_Y, max_bytes):
+        onp.matmul(X[rows, :], Y.T, out=out[rows, :])
+        if transform is not None:
+            transform(out[rows, :])
+    return out
+
+def medianSelect(values):
+    '''
+    Median of the 1-D array `values` by selection (partial sort), reordering `values` in place
+    '''
+    m = len(values)
+    k = m//2
+    if m % 2 == 1:
+        values.partition(k)
+        return values[k]
+    values.partition([k-1, k])
+    return (values[k-1] + values[k])/2
+
+def pairwiseSqDist(X, Y, out=None, transform=None, max_bytes=None):
+    '''
+    Matrix of squared distances ||x_i - y_j||^2 of the rows of `X` and `Y`, computed in row blocks as ||x_i||^2 + ||y_j||^2 - 2<x_i, y_j>
+    Avoids the (n_X x n_Y x p) temporary of broadcasting. Round-off is clamped at 0, and the diagonal is exactly 0 if `X` is `Y`
+    Single precision if both are float32, double otherwise
+    `transform` is optionally applied in place to each block, e.g. to turn it into a kernel matrix
+    '''
+    n_X, n_Y = X.shape[0], Y.shape[0]
+    if out is None:
+        out = onp.empty([n_X, n_Y], dtype=onp.result_type(X, Y, onp.float32))
+    sq_X = (X**2).sum(axis=1)
+    sq_Y = sq_X if Y is X else (Y**2).sum(axis=1)
+    for rows in pairwiseRowBlocks(n_X, n_Y, max_bytes):
+        D = out[rows, :]
+        onp.matmul(X[rows, :], Y.T, out=D)
+        innerToSqDist(D, sq_X[rows], sq_Y, rows.start if Y is X else None)
+        if transform is not None:
+            transform(D)
+    return out
+
+def innerToSqDist(D, sq_X, sq_Y, diag_offset=None):
+    '''
+    Turn the block `D` of inner products into squared distances in place, given the squared norms `sq_X` of its rows and `sq_Y` of its columns
+    If `diag_offset` is given, entries (i, `diag_offset`+i) are set to exactly 0
+    '''
+    D *= -2.
+    D += sq_X.reshape(-1, 1)
+    D += sq_Y.reshape(1, -1)
+    onp.maximum(D, 0., out=D)
+    if diag_offset is not None:
+        D[onp.arange(D.shape[0]), onp.arange(diag_offset, diag_offset + D.shape[0])] = 0.
+    pass
+
+def arrayFingerprint(X):
+    '''
+    Content hash of the array `X` (shape, dtype and values)
+    '''
+    X = onp.ascontiguousarray(X)
+    h = hashlib.blake2b(digest_size=16)
+    h.update(str((X.shape, X.dtype.str)).encode())
+    h.update(X.reshape(-1).view(onp.uint8))
+    return h.hexdigest()
+
+class kernel_cache(object):
+    def __init__(self, max_bytes=2**30):
+        '''
+        LRU cache of kernel, inner product and squared distance matrices, keyed by the fingerprints of the two samples, the kernel class and its parameters
+        Holds at most `max_bytes` of matrices; the least recently used are evicted first
+        Cached matrices are made read-only, so copy them before modifying in place
+        Enable for all kernels with `kernel.set_cache`
+        '''
+        self._max_bytes = max_bytes
+        self._entries = OrderedDict()
+        self.nbytes = 0
+        self.hits = 0
+        self.misses = 0
+        pass
+
+    def __len__(self):
+        return len(self._entries)
+
+    def get(self, key):
+        value = self._entries.get(key)
+        if value is None:
+            self.misses += 1
+        else:
+            self._entries.move_to_end(key)
+            self.hits += 1
+        return value
+
+    def put(self, key, value):
+        if value.nbytes > self._max_bytes:
+            return value
+        if key in self._entries:
+            self.nbytes -= self._entries.pop(key).nbytes
+        value.flags.writeable = False
+        self._entries[key] = value
+        self.nbytes += value.nbytes
+        while self.nbytes > self._max_bytes:
+            _, old = self._entries.popitem(last=False)
+            self.nbytes -= old.nbytes
+        return value
+
+    def matrix(self, key, f):
+        '''
+        Cached matrix under `key`, computed by `f`() on a miss
+        '''
+        value = self.get(key)
+        if value is None:
+            value = self.put(key, f())
+        return value
+
+    def clear(self):
+        self._entries.clear()
+        self.nbytes = 0
+        pass
+
+def cachedInner(X, Y, cache, fingerprints):
+    '''
+    Matrix of inner products of the rows of `X` and `Y` from the `kernel_cache` `cache`, where `fingerprints` = (`arrayFingerprint(X)`, `arrayFingerprint(Y)`)
+    '''
+    return cache.matrix(('inner',) + fingerprints, lambda: pairwiseInner(X, Y))
+
+def cachedSqDist(X, Y, cache, fingerprints):
+    '''
+    Matrix of squared distances of the rows of `X` and `Y` from the `kernel_cache` `cache`, derived from the (cached) inner products so that linear and RBF kernels share them
+    '''
+    def f():
+        D = onp.array(cachedInner(X, Y, cache, fingerprints))
+        sq_X = (X**2).sum(axis=1)
+        same = fingerprints[0] == fingerprints[1]
+        sq_Y = sq_X if same else (Y**2).sum(axis=1)
+        innerToSqDist(D, sq_X, sq_Y, 0 if same else None)
+        return D
+    return cache.matrix(('sqdist',) + fingerprints, f)
+
 class kernel(object):
+    # Shared `kernel_cache`, disabled by default
+    _cache = None
+    # Compute dtype of the kernel matrices (see `_cast`); None keeps the dtype of the samples
+    _dtype = None
+
     def __init__(self, X, Y):
         '''
         Generic kernel class
@@ -44,6 +312,32 @@ class kernel(object):
         self._Y = Y
         pass
 
+    @staticmethod
+    def set_cache(cache):
+        '''
+        Cache kernel matrices of all kernels in the `kernel_cache` `cache`; None disables caching
+        '''
+        kernel._cache = cache
+        pass
+
+    def _pooled_sample(self):
+        # X and Y stacked, unless they are already the same (pooled) sample
+        if self._X is self._Y or (self._X.shape == self._Y.shape and onp.allclose(self._X, self._Y)):
+            return self._X
+        return onp.vstack([self._X, self._Y])
+
+    def _cast(self, A, B):
+        # `A` and `B` in the compute dtype, keeping `B is A`
+        if self._dtype is None:
+            return A, B
+        A_c = onp.asarray(A, dtype=self._dtype)
+        return A_c, (A_c if B is A else onp.asarray(B, dtype=self._dtype))
+
+    @staticmethod
+    def _fingerprints(A, B):
+        fp_A = arrayFingerprint(A)
+        return (fp_A, fp_A if B is A else arrayFingerprint(B))
+
     @property
     def params(self):
         pass
@@ -69,20 +363,103 @@ class kernel(object):
         '''
         pass
 
+    def f_kernel_matrix(self, A, B):
+        '''
+        Kernel matrix K_(i, j) = k(a_i, b_j) between arbitrary samples `A` and `B`, using the learned parameters
+        Returns None if the kernel only supports `eval`
+        '''
+        pass
+
+    def f_kernel_pairs(self, A, B):
+        '''
+        Kernel values k(a_i, b_i) of the matching rows of `A` and `B`
+        Defaults to calling `f_kernel` on each pair
+        '''
+        assert len(A) == len(B)
+        return onp.array([self.f_kernel(a, b) for a, b in zip(A, B)], dtype=float)
+
+    def learn_from_inner(self, G, sq_norms):
+        '''
+        Learn kernel parameters given the inner products `G` and squared norms `sq_norms` of the rows of the pooled sample, without modifying `G`
+        Lets composite kernels share work between kernels on overlapping groups of columns. Defaults to `learn`
+        '''
+        self.learn()
+        pass
+
+    def features(self, A):
+        '''
+        Finite-dimensional feature map Phi(A) with k(a_i, b_j) = <Phi(a_i), Phi(b_j)>, used to compute MMD tests in feature space (see `lowrank_gram_matrix`)
+        Returns None if the kernel has no explicit feature map
+        '''
+        pass
+
+    def _kernel_block(self, A, B):
+        # Kernel matrix between rows of `A` and `B`, through `f_kernel_pairs` if the kernel can't evaluate arbitrary blocks
+        K = self.f_kernel_matrix(A, B)
+        if K is not None:
+            return K
+        n_A, n_B = len(A), len(B)
+        K = onp.empty([n_A, n_B])
+        for rows in pairwiseRowBlocks(n_A, n_B * A.shape[1]):
+            I, J = onp.divmod(onp.arange(rows.start * n_B, rows.stop * n_B), n_B)
+            K[rows, :] = self.f_kernel_pairs(A[I], B[J]).reshape(-1, n_B)
+        return K
+
+    def nystroem_features(self, A, num_landmarks, method='uniform', rng=None, ridge=None):
+        '''
+        Nystrom features Phi of the rows of `A`, with Phi Phi' = C W^+ C' ~ K(A, A) for the kernel matrices C = K(A, L) and W = K(L, L) of `num_landmarks` landmark rows L of `A`
+        `method`='uniform' draws the landmarks uniformly with `rng`; 'leverage' draws them in proportion to their ridge leverage scores (ridge `ridge`, default 1e-3 times the mean of diag(K)) under a uniform pilot approximation
+        Only O(n `num_landmarks`) kernel values are computed, with `f_kernel_matrix` or, for kernels that only support `eval` and `f_kernel`, `f_kernel_pairs`
+        '''
+        assert method in ['uniform', 'leverage']
+        if rng is None:
+            rng = onp.random.default_rng()
+        n = len(A)
+        m = min(int(num_landmarks), n)
+        landmarks = onp.sort(rng.choice(n, m, replace=False))
+        if method == 'leverage':
+            Phi = self._nystroem(A, landmarks)
+            if ridge is None:
+                ridge = 1e-3 * (Phi**2).sum()/n
+            G = Phi.T @ Phi + ridge * onp.identity(Phi.shape[1])
+            scores = (Phi * onp.linalg.solve(G, Phi.T).T).sum(axis=1)
+            landmarks = onp.sort(rng.choice(n, m, replace=False, p=scores/scores.sum()))
+        return self._nystroem(A, landmarks)
+
+    def _nystroem(self, A, landmarks):
+        L = A[landmarks]
+        C = self._kernel_block(A, L)
+        W = C[landmarks, :]
+        s, U = onp.linalg.eigh((W + W.T)/2.)
+        # Pseudo-inverse square root of W
+        keep = s > s.max() * len(s) * onp.finfo(s.dtype).eps
+        return C @ (U[:, keep] / onp.sqrt(s[keep]))
+
+    def eval_from_inner(self, G, sq_A, sq_B, diag_offset=None):
+        '''
+        Kernel matrix between samples A and B given their inner products `G` and the squared norms `sq_A`, `sq_B` of their rows, without modifying `G` (see `innerToSqDist` for `diag_offset`)
+        Returns None if the kernel can't be evaluated from inner products
+        '''
+        pass
+
 class rbf_kernel(kernel):
-    def __init__(self, X, Y, tau=None, **kwargs):
+    def __init__(self, X, Y, tau=None, median_num_pairs=None, median_rng=None, dtype=None, **kwargs):
         ''' 
         RBF kernel class; k(x, y) = exp(-(||x-y||^2)/tau)
         `X`, `Y` are (n_x x p) and (n_y x p) samples
         If bandwidth `tau` is None, uses the median heuristic
+        If `median_num_pairs` is given, the median heuristic uses that many random pairs drawn with `median_rng` instead of all pairs
+        `dtype`='float32' computes the kernel matrices in single precision (default: the dtype of the samples)
         '''
         assert X.shape[1] == Y.shape[1]
         assert len(X.shape) == 2 and len(X.shape) == len(Y.shape)
         if tau is not None:
             assert isinstance(tau, int) or isinstance(tau, float)
-        self._X = X
-        self._Y = Y
+        self._dtype = None if dtype is None else onp.dtype(dtype)
+        self._X, self._Y = self._cast(X, Y)
         self._tau = tau
+        self._median_num_pairs = median_num_pairs
+        self._median_rng = median_rng
         pass
 
     @property
@@ -93,41 +470,97 @@ class rbf_kernel(kernel):
         self._tau = params
         pass
 
-    def learn(self, method='median_heuristic', eval=False):
+    def learn(self, method='median_heuristic', eval=False, num_pairs=None, rng=None):
         '''
         Learn kernel parameters
+        The median heuristic sets `tau` to the median squared distance between distinct points of the pooled sample. If `num_pairs` (default `median_num_pairs`) is given and smaller than the number of distinct pairs, only `num_pairs` random pairs drawn with `rng` (default `median_rng`) are used
         '''
         assert method in ['median_heuristic']
+        if num_pairs is None:
+            num_pairs = self._median_num_pairs
+        if rng is None:
+            rng = self._median_rng
         n_X, p = self._X.shape
         n_Y = self._Y.shape[0]
         if method == 'median_heuristic':
             # Pool the samples if not already pooled
-            if onp.allclose(self._X, self._Y):
-                X = self._X
-                Y = self._Y
-            else:
-                X = Y = onp.vstack([self._X, self._Y])
+            X = self._pooled_sample()
             
             n = X.shape[0]
-            norm2 = ((X.reshape(n, 1, p) - Y.reshape(1, n, p))**2).sum(2)
-            norm2_sorted = onp.sort(norm2.reshape(n**2, 1).flatten())
-            if (n**2) % 2 == 0:
-                tau = (norm2_sorted[int(n**2/2)-1] + norm2_sorted[int(n**2/2)])/2
+            norm2 = None
+            if num_pairs is not None and int(num_pairs) < n*(n-1)//2:
+                tau = medianSelect(self._sample_sqdist(X, int(num_pairs), rng))
             else:
-                tau = norm2_sorted[int(n**2/2)]
+                norm2 = self._sqdist(X, X)
+                tau = self._median_sqdist(norm2)
         else:
             raise ValueError
-        self._tau = tau
+        self._tau = float(tau)
 
         if eval == True:
+            if norm2 is None or kernel._cache is not None:
+                return self.eval()
             if n_X != n: 
                 # If we pooled the samples, unpool here
-                return onp.exp(-norm2[:, :n_X][n_X:, :]/self._tau)
-            else:
-                return onp.exp(-norm2/self._tau)
+                norm2 = norm2[:n_X, n_X:]
+            norm2 /= -self._tau
+            return onp.exp(norm2, out=norm2)
         else:
             pass
 
+    def _median_sqdist(self, norm2):
+        # Median over distinct pairs only: the strict upper triangle
+        n = norm2.shape[0]
+        upper = onp.empty(n*(n-1)//2, dtype=norm2.dtype)
+        offset = 0
+        for i in range(n-1):
+            upper[offset:(offset+n-1-i)] = norm2[i, (i+1):]
+            offset += n-1-i
+        return medianSelect(upper)
+
+    def learn_from_inner(self, G, sq_norms):
+        '''
+        Median heuristic from the inner products `G` of the pooled sample
+        '''
+        if self.subsamples_pairs(G.shape[0]):
+            self.learn()
+        else:
+            norm2 = onp.array(G)
+            innerToSqDist(norm2, sq_norms, sq_norms, 0)
+            self._tau = float(self._median_sqdist(norm2))
+        pass
+
+    def subsamples_pairs(self, n):
+        '''
+        Whether the median heuristic on a pooled sample of `n` rows uses a random subset of `median_num_pairs` pairs, in O(`median_num_pairs`) memory
+        '''
+        return self._median_num_pairs is not None and int(self._median_num_pairs) < n*(n-1)//2
+
+    def eval_from_inner(self, G, sq_A, sq_B, diag_offset=None):
+        '''
+        Kernel matrix K_(i, j) = exp(-(||a_i-b_j||^2)/tau) from inner products
+        '''
+        K = onp.array(G)
+        innerToSqDist(K, sq_A, sq_B, diag_offset)
+        self._transform(K)
+        return K
+
+    def _sample_sqdist(self, X, num_pairs, rng=None):
+        '''
+        Squared distances between `num_pairs` random pairs of distinct rows of `X`
+        '''
+        if rng is None:
+            rng = onp.random.default_rng()
+        n, p = X.shape
+        i = rng.integers(n, size=num_pairs)
+        j = (i + rng.integers(1, n, size=num_pairs)) % n
+        norm2 = onp.empty(num_pairs)
+        block_size = max(1, PAIRWISE_MAX_BYTES // (8 * p))
+        for start in range(0, num_pairs, block_size):
+            end = min(start + block_size, num_pairs)
+            norm2[start:end] = ((X[i[start:end], :] - X[j[start:end], :])**2).sum(axis=1)
+        return norm2
+
     def eval(self):
         '''
         Generate kernel matrix K from samples X and Y with K_(i, j) = exp(-(||x_i-y_j||^2)/tau)
@@ -135,11 +568,38 @@ class rbf_kernel(kernel):
         if self._tau is None:
             K = self.learn(eval=True)
         else:
-            n_X, p = self._X.shape
-            n_Y = self._Y.shape[0]
-            K = onp.exp(-(((self._X.reshape(n_X, 1, p) - self._Y.reshape(1, n_Y, p))**2).sum(2))/self._tau)
+            K = self._kernel_matrix(self._X, self._Y)
         return K
 
+    def _transform(self, D):
+        # Squared distances to kernel values, in place
+        D /= -self._tau
+        onp.exp(D, out=D)
+        pass
+
+    def _sqdist(self, A, B):
+        if kernel._cache is None:
+            return pairwiseSqDist(A, B)
+        return cachedSqDist(A, B, kernel._cache, self._fingerprints(A, B))
+
+    def _kernel_matrix(self, A, B):
+        if kernel._cache is None:
+            return pairwiseSqDist(A, B, transform=self._transform)
+        fingerprints = self._fingerprints(A, B)
+        def f():
+            K = onp.array(cachedSqDist(A, B, kernel._cache, fingerprints))
+            self._transform(K)
+            return K
+        return kernel._cache.matrix((type(self).__name__, self._tau) + fingerprints, f)
+
+    def f_kernel_matrix(self, A, B):
+        '''
+        Kernel matrix K_(i, j) = exp(-(||a_i-b_j||^2)/tau)
+        '''
+        if self._tau is None:
+            self.learn()
+        return self._kernel_matrix(*self._cast(A, B))
+
     def f_kernel(self, x, y, tau=None):
         '''
         Kernel function k(x, y) = exp(-(||x-y||^2)/tau)
@@ -148,17 +608,33 @@ class rbf_kernel(kernel):
             tau = self._tau
         assert len(x.shape) == len(y.shape) and len(x.shape) == 1
         return onp.exp(-((x-y)**2).sum()/tau)
+
+    def f_kernel_pairs(self, A, B):
+        '''
+        Kernel values k(a_i, b_i) = exp(-(||a_i-b_i||^2)/tau), computed in row blocks
+        '''
+        assert A.shape == B.shape and len(A.shape) == 2
+        if self._tau is None:
+            self.learn()
+        A, B = self._cast(A, B)
+        n, p = A.shape
+        out = onp.empty(n, dtype=onp.result_type(A, B, onp.float32))
+        for rows in pairwiseRowBlocks(n, p):
+            out[rows] = ((A[rows, :] - B[rows, :])**2).sum(axis=1)
+        out /= -self._tau
+        return onp.exp(out, out=out)
       
 class linear_kernel(kernel):
     '''
     Linear kernel class; k(x, y) = <x, y>
     `X`, `Y` are (n_x x p) and (n_y x p) samples
+    `dtype`='float32' computes the kernel matrices in single precision (default: the dtype of the samples)
     '''
-    def __init__(self, X, Y, **kwargs):
+    def __init__(self, X, Y, dtype=None, **kwargs):
         assert X.shape[1] == Y.shape[1]
         assert len(X.shape) == 2 and len(X.shape) == len(Y.shape)
-        self._X = X
-        self._Y = Y
+        self._dtype = None if dtype is None else onp.dtype(dtype)
+        self._X, self._Y = self._cast(X, Y)
         pass
 
     @property
@@ -181,20 +657,211 @@ class linear_kernel(kernel):
         ''' 
         Generate kernel matrix K from samples X and Y with K_(i, j) = <x_i, y_j>
         '''
-        n_X, p = self._X.shape
-        n_Y = self._Y.shape[0]
-        K = (self._X.reshape(n_X, 1, p) * self._Y.reshape(1, n_Y, p)).sum(2)
+        K = self.f_kernel_matrix(self._X, self._Y)
         return K
 
+    def f_kernel_matrix(self, A, B):
+        '''
+        Kernel matrix K_(i, j) = <a_i, b_j>
+        '''
+        A, B = self._cast(A, B)
+        if kernel._cache is None:
+            return pairwiseInner(A, B)
+        return cachedInner(A, B, kernel._cache, self._fingerprints(A, B))
+
+    def eval_from_inner(self, G, sq_A, sq_B, diag_offset=None):
+        '''
+        Kernel matrix K_(i, j) = <a_i, b_j>, which is `G` itself
+        '''
+        return G
+
     def f_kernel(self, x, y):
         '''
         Kernel function k(x, y) = <x, y>
         '''
         assert len(x.shape) == len(y.shape) and len(x.shape) == 1
         return onp.dot(x, y)
+
+    def f_kernel_pairs(self, A, B):
+        '''
+        Kernel values k(a_i, b_i) = <a_i, b_i>
+        '''
+        assert A.shape == B.shape and len(A.shape) == 2
+        A, B = self._cast(A, B)
+        return onp.einsum('ij,ij->i', A, B)
       
+class rff_kernel(rbf_kernel):
+    def __init__(self, X, Y, tau=None, num_features=500, feature_rng=None, median_num_pairs=2**16, median_rng=None, dtype=None, **kwargs):
+        '''
+        Random Fourier feature approximation of the RBF kernel (Rahimi and Recht 2007); k(x, y) = <Phi(x), Phi(y)> ~ exp(-(||x-y||^2)/tau)
+        Phi(x) = [cos(W'x), sin(W'x)]/sqrt(`num_features`) with `num_features` frequencies W ~ N(0, 2/tau), drawn once with `feature_rng`
+        MMD tests on this kernel run in O(n `num_features`) feature space (see `lowrank_gram_matrix`)
+        By default the median heuristic uses `median_num_pairs` random pairs (see `rbf_kernel`)
+        '''
+        super().__init__(X, Y, tau=tau, median_num_pairs=median_num_pairs, median_rng=median_rng, dtype=dtype)
+        self._num_features = int(num_features)
+        self._feature_rng = onp.random.default_rng() if feature_rng is None else feature_rng
+        self._omega = None
+        pass
+
+    # Evaluate groups of composite kernels through the features rather than the exact RBF kernel
+    eval_from_inner = kernel.eval_from_inner
+
+    def learn(self, method='median_heuristic', eval=False, num_pairs=None, rng=None):
+        '''
+        Learn `tau` as `rbf_kernel.learn`
+        '''
+        super().learn(method=method, eval=False, num_pairs=num_pairs, rng=rng)
+        if eval == True:
+            return self.eval()
+        else:
+            pass
+
+    def features(self, A):
+        '''
+        (n x 2*`num_features`) random Fourier features of the rows of `A`, computed in row blocks
+        '''
+        if self._tau is None:
+            self.learn()
+        if self._omega is None:
+            # Standard normal frequencies, scaled by the current bandwidth on use
+            self._omega = self._feature_rng.normal(size=(A.shape[1], self._num_features))
+        A, _ = self._cast(A, A)
+        D = self._num_features
+        n = A.shape[0]
+        out = onp.empty([n, 2*D], dtype=onp.result_type(A, onp.float32))
+        omega = (self._omega * onp.sqrt(2./self._tau)).astype(out.dtype)
+        for rows in pairwiseRowBlocks(n, 2*D):
+            Z = A[rows, :] @ omega
+            onp.cos(Z, out=out[rows, :D])
+            onp.sin(Z, out=out[rows, D:])
+        out /= onp.sqrt(D)
+        return out
+
+    def eval(self):
+        '''
+        Approximate kernel matrix Phi(X) Phi(Y)'
+        '''
+        if self._tau is None:
+            self.learn()
+        return self.f_kernel_matrix(self._X, self._Y)
+
+    def f_kernel_matrix(self, A, B):
+        Phi_A = self.features(A)
+        return pairwiseInner(Phi_A, Phi_A if B is A else self.features(B))
+
+    def f_kernel_pairs(self, A, B):
+        assert A.shape == B.shape and len(A.shape) == 2
+        return onp.einsum('ij,ij->i', self.features(A), self.features(B))
+
+    def f_kernel(self, x, y):
+        assert len(x.shape) == len(y.shape) and len(x.shape) == 1
+        return self.f_kernel_pairs(x.reshape(1, -1), y.reshape(1, -1))[0]
+
+def overridesKernel(K, name):
+    '''
+    Whether the kernel object `K` overrides the `kernel` method `name`
+    '''
+    return getattr(type(K), name) is not getattr(kernel, name)
+
+def columnAtoms(lst_groups, p):
+    '''
+    Partition the columns used by the groups in `lst_groups` (of distinct column indices in 0, ..., `p`-1) into atoms: sets of columns belonging to exactly the same groups
+    Returns the atoms (arrays of columns) and, for each group, the indices of the atoms it is made of
+    '''
+    membership = {}
+    for i, group in enumerate(lst_groups):
+        for c in onp.arange(p)[group].reshape(-1):
+            membership.setdefault(int(c), []).append(i)
+    atoms = {}
+    for c in sorted(membership):
+        atoms.setdefault(tuple(membership[c]), []).append(c)
+    lst_atoms = [onp.array(cols) for cols in atoms.values()]
+    lst_group_atoms = [[a for a, key in enumerate(atoms) if i in key] for i in range(len(lst_groups))]
+    return lst_atoms, lst_group_atoms
+
+def groupInnerProducts(lst_groups, A, B, wanted=None):
+    '''
+    Yield (inner products, squared row norms of `A`, squared row norms of `B`) of each group of columns in `lst_groups`, or None for groups not in `wanted` (default all)
+    Each atom of columns shared by the same groups (see `columnAtoms`) is multiplied out once, when its first group is reached, added into the totals of all the groups that use it and freed, so at most one atom's products are in memory besides the totals of the groups not yet yielded. The yielded arrays must not be modified
+    '''
+    num_groups = len(lst_groups)
+    if wanted is None:
+        wanted = [True] * num_groups
+    same = B is A
+    lst_atoms, lst_group_atoms = columnAtoms(lst_groups, A.shape[1])
+    atom_users = [[] for _ in lst_atoms]
+    for i in range(num_groups):
+        if wanted[i] == True:
+            for a in lst_group_atoms[i]:
+                atom_users[a].append(i)
+    totals = {}
+    for i in range(num_groups):
+        if wanted[i] == False:
+            yield None
+            continue
+        for a in lst_group_atoms[i]:
+            if atom_users[a][0] != i:
+                # Already added when an earlier group was reached
+                continue
+            A_a = A[:, lst_atoms[a]]
+            B_a = A_a if same else B[:, lst_atoms[a]]
+            if kernel._cache is None:
+                G_a = pairwiseInner(A_a, B_a)
+            else:
+                G_a = cachedInner(A_a, B_a, kernel._cache, kernel._fingerprints(A_a, B_a))
+            sq_A_a = (A_a**2).sum(axis=1)
+            sq_B_a = sq_A_a if same else (B_a**2).sum(axis=1)
+            for j in atom_users[a]:
+                if j not in totals:
+                    # A group's total can be the atom's products themselves if nothing will be added to them
+                    if len(lst_group_atoms[j]) == 1 or (len(atom_users[a]) == 1 and kernel._cache is None):
+                        totals[j] = [G_a, sq_A_a, sq_B_a]
+                    else:
+                        totals[j] = [onp.array(G_a), sq_A_a, sq_B_a]
+                else:
+                    totals[j][0] += G_a
+                    totals[j][1] = totals[j][1] + sq_A_a
+                    totals[j][2] = totals[j][2] + sq_B_a
+            del A_a, B_a, G_a
+        G, sq_A, sq_B = totals.pop(i)
+        yield G, sq_A, sq_B
+
+def learnGroupKernels(lst_kernels, lst_groups, X):
+    '''
+    Learn the parameters of each kernel in `lst_kernels` on its group of columns of the pooled sample `X`, sharing inner products between groups for kernels implementing `learn_from_inner`
+    RBF kernels with a subsampled median heuristic (see `rbf_kernel.subsamples_pairs`) learn on their own, so no (n x n) inner products are formed for them
+    '''
+    n = X.shape[0]
+    wanted = [overridesKernel(k, 'learn_from_inner') and not (isinstance(k, rbf_kernel) and k.subsamples_pairs(n)) for k in lst_kernels]
+    for i, inner in enumerate(groupInnerProducts(lst_groups, X, X, wanted)):
+        if inner is None:
+            lst_kernels[i].learn()
+        else:
+            lst_kernels[i].learn_from_inner(inner[0], inner[1])
+    pass
+
+def groupKernelMatrices(lst_kernels, lst_groups, A, B, own=False):
+    '''
+    Yield the kernel matrix of each kernel in `lst_kernels` on its group of columns of `A` and `B` (None if unsupported)
+    Kernels implementing `eval_from_inner` share the inner products of `groupInnerProducts`, so overlapping groups cost one pass over the columns
+    If `own`=True, `A` and `B` are the samples the kernels were constructed with, so kernels that only support `eval` (e.g. graph kernels) yield their `eval`
+    '''
+    same = B is A
+    wanted = [overridesKernel(k, 'eval_from_inner') for k in lst_kernels]
+    for i, inner in enumerate(groupInnerProducts(lst_groups, A, B, wanted)):
+        if inner is None:
+            group = lst_groups[i]
+            A_i = A[:, group].reshape(-1, len(group))
+            K_i = lst_kernels[i].f_kernel_matrix(A_i, A_i if same else B[:, group].reshape(-1, len(group)))
+            if K_i is None and own == True:
+                K_i = lst_kernels[i].eval()
+            yield K_i
+        else:
+            yield lst_kernels[i].eval_from_inner(inner[0], inner[1], inner[2], 0 if same else None)
+
 class sum_kernel(kernel):
-    def __init__(self, X, Y, lst_classes, lst_groups, lst_weights=None, lst_params=None, lst_kwargs=None, **kwargs):
+    def __init__(self, X, Y, lst_classes, lst_groups, lst_weights=None, lst_params=None, lst_kwargs=None, dtype=None, **kwargs):
         '''
         Sum of kernels
         `X`, `Y` are (n_x x p) and (n_y x p) samples
@@ -203,6 +870,7 @@ class sum_kernel(kernel):
         `lst_weights` = list of sum weights used for each kernel
         `lst_params` = list of parameters used for each kernel and set via the `set_params` class method
         `lst_kwargs` = list of **kwargs to pass to each kernel
+        `dtype`='float32' computes the kernel matrices in single precision: the kernels are given single precision columns
         '''
         assert X.shape[1] == Y.shape[1]
         assert len(X.shape) == 2 and len(X.shape) == len(Y.shape)
@@ -217,8 +885,8 @@ class sum_kernel(kernel):
         if lst_params is not None:
             assert len(lst_params) == len(lst_classes)
         
-        self._X = X
-        self._Y = Y
+        self._dtype = None if dtype is None else onp.dtype(dtype)
+        self._X, self._Y = self._cast(X, Y)
         self._lst_kernels = [None] * len(lst_classes)
         self._num_kernels = len(lst_classes)
         
@@ -231,22 +899,32 @@ class sum_kernel(kernel):
         
         pass
     
-    def learn(self, eval=False):
-        n_X = self._X.shape[0]
-        n_Y = self._Y.shape[0]
-        if eval==True:
-            K = onp.zeros(shape=[n_X, n_Y])
-        
+    def _init_kernels(self):
         for i in range(self._num_kernels):
-            self._lst_kernels[i] = self._lst_classes[i](self._X[:, self._lst_groups[i]].reshape(-1, len(self._lst_groups[i])), self._Y[:, self._lst_groups[i]].reshape(-1, len(self._lst_groups[i])), **self._lst_kwargs[i])
-            if eval==True:
-                K_i = self._lst_kernels[i].learn(eval=True)
-                K += self._lst_weights[i] * K_i
+            group = self._lst_groups[i]
+            self._lst_kernels[i] = self._lst_classes[i](self._X[:, group].reshape(-1, len(group)), self._Y[:, group].reshape(-1, len(group)), **self._lst_kwargs[i])
+            if self._lst_params is not None:
+                self._lst_kernels[i].set_params(self._lst_params[i])
+        pass
+
+    def _ensure_kernels(self):
+        # Construct (and learn, unless `lst_params` is given) the kernels on first use
+        if any([k is None for k in self._lst_kernels]):
+            if self._lst_params is None:
+                self.learn()
             else:
-                self._lst_kernels[i].learn(eval=False)
-                
+                self._init_kernels()
+        pass
+
+    def learn(self, eval=False):
+        '''
+        Learn the parameters of each kernel, unless they are given in `lst_params`
+        '''
+        self._init_kernels()
+        if self._lst_params is None:
+            learnGroupKernels(self._lst_kernels, self._lst_groups, self._pooled_sample())
         if eval == True:
-            return K
+            return self.f_kernel_matrix(self._X, self._Y)
         else:
             pass        
 
@@ -254,27 +932,51 @@ class sum_kernel(kernel):
         if self._lst_params is None:
             K = self.learn(eval=True)
         else:
-            n_X = self._X.shape[0]
-            n_Y = self._Y.shape[0]
-            K = onp.zeros(shape=[n_X, n_Y])    
-            for i in range(self._num_kernels):
-                self._lst_kernels[i] = self._lst_classes[i](self._X[:, self._lst_groups[i]].reshape(-1, len(self._lst_groups[i])), self._Y[:, self._lst_groups[i]].reshape(-1, len(self._lst_groups[i])))
-                self._lst_kernels[i].set_params(self._lst_params[i])
-                K_i = self._lst_kernels[i].eval()
-                K += self._lst_weights[i] * K_i
+            self._init_kernels()
+            K = self.f_kernel_matrix(self._X, self._Y)
+        return K
+
+    def f_kernel_matrix(self, A, B):
+        '''
+        Weighted sum of the kernel matrices of each kernel on its group of columns of `A` and `B` (see `groupKernelMatrices`)
+        '''
+        self._ensure_kernels()
+        A, B = self._cast(A, B)
+        K = None
+        own = A is self._X and B is self._Y
+        for i, K_i in enumerate(groupKernelMatrices(self._lst_kernels, self._lst_groups, A, B, own=own)):
+            if K_i is None:
+                return None
+            if K is None:
+                K = float(self._lst_weights[i]) * K_i
+            else:
+                K += float(self._lst_weights[i]) * K_i
         return K
 
     def f_kernel(self, x, y, **kwargs):
         assert len(x.shape) == len(y.shape) and len(x.shape) == 1
+        self._ensure_kernels()
         out = 0.
         for i, group in enumerate(self._lst_groups):
-            x_group = x[group]
-            y_group = y[group]
-            out += lst_weights[i] * lst_kernels[i].f_eval(x_group, y_group)
+            x_group = x[group].reshape(-1)
+            y_group = y[group].reshape(-1)
+            out += self._lst_weights[i] * self._lst_kernels[i].f_kernel(x_group, y_group)
+        return out
+
+    def f_kernel_pairs(self, A, B):
+        '''
+        Kernel values k(a_i, b_i) of the matching rows of `A` and `B`
+        '''
+        assert len(A) == len(B)
+        self._ensure_kernels()
+        A, B = self._cast(A, B)
+        out = onp.zeros(len(A))
+        for i, group in enumerate(self._lst_groups):
+            out += self._lst_weights[i] * self._lst_kernels[i].f_kernel_pairs(A[:, group].reshape(-1, len(group)), B[:, group].reshape(-1, len(group)))
         return out
 
 class prod_kernel(kernel):
-    def __init__(self, X, Y, lst_classes, lst_groups, lst_params=None, lst_kwargs=None, **kwargs):
+    def __init__(self, X, Y, lst_classes, lst_groups, lst_params=None, lst_kwargs=None, dtype=None, **kwargs):
         '''
         Product of kernels
         `X`, `Y` are (n_x x p) and (n_y x p) samples
@@ -283,6 +985,7 @@ class prod_kernel(kernel):
         `lst_weights` = list of sum weights used for each kernel
         `lst_params` = list of parameters used for each kernel and set via the `set_params` class method
         `lst_kwargs` = list of **kwargs to pass to each kernel
+        `dtype`='float32' computes the kernel matrices in single precision: the kernels are given single precision columns
         '''
         assert X.shape[1] == Y.shape[1]
         assert len(X.shape) == 2 and len(X.shape) == len(Y.shape)
@@ -295,8 +998,8 @@ class prod_kernel(kernel):
         if lst_params is not None:
             assert len(lst_params) == len(lst_classes)
         
-        self._X = X
-        self._Y = Y
+        self._dtype = None if dtype is None else onp.dtype(dtype)
+        self._X, self._Y = self._cast(X, Y)
         self._lst_kernels = [None] * len(lst_classes)
         self._num_kernels = len(lst_classes)
         
@@ -307,26 +1010,32 @@ class prod_kernel(kernel):
         
         pass
     
-    def learn(self, eval=False):
-        n_X = self._X.shape[0]
-        n_Y = self._Y.shape[0]
-        if eval==True:
-            K = onp.ones(shape=[n_X, n_Y])
-        
+    def _init_kernels(self):
         for i in range(self._num_kernels):
-            self._lst_kernels[i] = self._lst_classes[i](
-              self._X[:, self._lst_groups[i]].reshape(-1, len(self._lst_groups[i])), 
-              self._Y[:, self._lst_groups[i]].reshape(-1, len(self._lst_groups[i])), 
-              **self._lst_kwargs[i]
-            )
-            if eval==True:
-                K_i = self._lst_kernels[i].learn(eval=True)
-                K *= K_i
+            group = self._lst_groups[i]
+            self._lst_kernels[i] = self._lst_classes[i](self._X[:, group].reshape(-1, len(group)), self._Y[:, group].reshape(-1, len(group)), **self._lst_kwargs[i])
+            if self._lst_params is not None:
+                self._lst_kernels[i].set_params(self._lst_params[i])
+        pass
+
+    def _ensure_kernels(self):
+        # Construct (and learn, unless `lst_params` is given) the kernels on first use
+        if any([k is None for k in self._lst_kernels]):
+            if self._lst_params is None:
+                self.learn()
             else:
-                self._lst_kernels[i].learn(eval=False)
-                
+                self._init_kernels()
+        pass
+
+    def learn(self, eval=False):
+        '''
+        Learn the parameters of each kernel, unless they are given in `lst_params`
+        '''
+        self._init_kernels()
+        if self._lst_params is None:
+            learnGroupKernels(self._lst_kernels, self._lst_groups, self._pooled_sample())
         if eval == True:
-            return K
+            return self.f_kernel_matrix(self._X, self._Y)
         else:
             pass        
 
@@ -334,123 +1043,431 @@ class prod_kernel(kernel):
         if self._lst_params is None:
             K = self.learn(eval=True)
         else:
-            n_X = self._X.shape[0]
-            n_Y = self._Y.shape[0]
-            K = onp.ones(shape=[n_X, n_Y])    
-            for i in range(self._num_kernels):
-                self._lst_kernels[i] = self._lst_classes[i](self._X[:, self._lst_groups[i]], self._Y[:, self._lst_groups[i]])
-                self._lst_kernels[i].set_params(self._lst_params[i])
-                K_i = self._lst_kernels[i].eval()
+            self._init_kernels()
+            K = self.f_kernel_matrix(self._X, self._Y)
+        return K
+
+    def f_kernel_matrix(self, A, B):
+        '''
+        Product of the kernel matrices of each kernel on its group of columns of `A` and `B` (see `groupKernelMatrices`)
+        '''
+        self._ensure_kernels()
+        A, B = self._cast(A, B)
+        K = None
+        own = A is self._X and B is self._Y
+        for i, K_i in enumerate(groupKernelMatrices(self._lst_kernels, self._lst_groups, A, B, own=own)):
+            if K_i is None:
+                return None
+            if K is None:
+                K = onp.array(K_i)
+            else:
                 K *= K_i
         return K
 
     def f_kernel(self, x, y, **kwargs):
         assert len(x.shape) == len(y.shape) and len(x.shape) == 1
+        self._ensure_kernels()
         out = 1.
         for i, group in enumerate(self._lst_groups):
-            x_group = x[group]
-            y_group = y[group]
-            out *= lst_kernels[i].f_eval(x_group, y_group)
+            x_group = x[group].reshape(-1)
+            y_group = y[group].reshape(-1)
+            out *= self._lst_kernels[i].f_kernel(x_group, y_group)
         return out   
+
+    def f_kernel_pairs(self, A, B):
+        '''
+        Kernel values k(a_i, b_i) of the matching rows of `A` and `B`
+        '''
+        assert len(A) == len(B)
+        self._ensure_kernels()
+        A, B = self._cast(A, B)
+        out = onp.ones(len(A))
+        for i, group in enumerate(self._lst_groups):
+            out *= self._lst_kernels[i].f_kernel_pairs(A[:, group].reshape(-1, len(group)), B[:, group].reshape(-1, len(group)))
+        return out
       
+def subsampledMedianKwargs(kernel, kwargs, num_pairs=2**16):
+    '''
+    Copy of the **kwargs `kwargs` of the kernel class `kernel` in which the median heuristic of RBF kernels (including those of a `sum_kernel` or `prod_kernel`) defaults to `num_pairs` random pairs (see `rbf_kernel`)
+    Used by the MMD tests when the full kernel matrix is never in memory, so that learning the bandwidth doesn't form it either
+    '''
+    kwargs = dict(kwargs)
+    if issubclass(kernel, rbf_kernel):
+        kwargs.setdefault('median_num_pairs', num_pairs)
+    elif kernel in [sum_kernel, prod_kernel] and 'lst_classes' in kwargs:
+        lst_kwargs = kwargs.get('lst_kwargs')
+        if lst_kwargs is None:
+            lst_kwargs = [{}] * len(kwargs['lst_classes'])
+        kwargs['lst_kwargs'] = [dict(kw) for kw in lst_kwargs]
+        for cls, kw in zip(kwargs['lst_classes'], kwargs['lst_kwargs']):
+            if issubclass(cls, rbf_kernel):
+                kw.setdefault('median_num_pairs', num_pairs)
+    return kwargs
+
 #######################################################################
 ############################# Geweke test #############################
 #######################################################################
-# def geweke_se2(g, L=0, center=True):
-#     '''
-#     Calculate the squared standard error of the estimate of E[`g`] (Geweke 1999, 3.7-8).
-#     '''
-#     L = int(L)
-#     M = g.shape[0]
-#     if center==True:
-#         g -= g.mean(axis=0)
-#     v = geweke_c(g=g, s=0)
-#     v_L = 0.
-#     if L != 0:
-#         w = (L-onp.arange(0, L))/L  # weights
-#         v *= w[0]
-#         assert L > 0 and L < M
-#         for s in range(1, L):
-#             v_L += w[s] * geweke_c(g=g, s=s)
-#     v = (v + 2*v_L)/M
-#     return v
-
-# def geweke_c(g, s):
-#     '''
-#     Calculate the biased `s`-lag autocovariance of *centered* samples `g`
-#     '''
-#     if s == 0:
-#         out = (g ** 2).mean(axis=0)
-#     else:
-#         M = g.shape[0]
-#         out = ((g[s:, :]) * (g[:(M-s), :])).sum(0)/float(M)  # biased
-#     return out
-
-def geweke_se2(g, L=None, force_int_L=False):
-    '''
-    Calculate the squared standard error of the estimate of E[`g`] (Geweke 1999, 3.7-8); depends on arch.
+# Lag windows for long-run variance estimation: (constant, characteristic exponent q, pilot lag rate) used in automatic bandwidth selection, as in arch.covariance.kernel
+LAG_WINDOWS = {
+    'bartlett': (1.1447, 1., 2/9),
+    'parzen': (2.6614, 2., 4/25),
+    'qs': (1.3221, 2., 2/25),
+}
+
+def autocovariance(g, max_lag=None, center=True, max_bytes=2**28):
+    '''
+    Biased autocovariances at lags 0, ..., `max_lag` (default M-1) of each column of the (M x p) samples `g`. Returns a ((max_lag+1) x p) matrix
+    All lags of a column are computed at once in O(M log M) via a zero-padded FFT. Columns are processed in blocks so that the FFT workspace stays within about `max_bytes`
+    If `center`=False, `g` is assumed to be centered already
+    '''
+    if len(g.shape) == 1:
+        g = g.reshape(-1, 1)
+    M, p = g.shape
+    if max_lag is None:
+        max_lag = M-1
+    max_lag = min(int(max_lag), M-1)
+    n_fft = scipy.fft.next_fast_len(M + max_lag)
+    block_size = max(1, int(max_bytes // (3 * 8 * n_fft)))
+    acov = onp.empty([max_lag+1, p])
+    for start in range(0, p, block_size):
+        g_block = g[:, start:(start+block_size)]
+        if center == True:
+            g_block = g_block - g_block.mean(axis=0)
+        f = scipy.fft.rfft(g_block, n=n_fft, axis=0)
+        acov[:, start:(start+block_size)] = scipy.fft.irfft(f.real**2 + f.imag**2, n=n_fft, axis=0)[:(max_lag+1), :]/M
+    return acov
+
+def effective_sample_size(g, center=True):
+    '''
+    Effective sample size of each column of the (M x p) chain `g`, using Geyer's (1992) initial monotone sequence estimator of the integrated autocorrelation time
+    '''
+    if len(g.shape) == 1:
+        g = g.reshape(-1, 1)
+    M = g.shape[0]
+    acov = autocovariance(g, center=center)
+    rho = acov/acov[0, :]
+    # Sums of adjacent pairs of autocorrelations, truncated at the first non-positive pair and made monotone
+    num_pairs = M//2
+    Gamma = rho[0:(2*num_pairs):2, :] + rho[1:(2*num_pairs):2, :]
+    positive = onp.cumprod(Gamma > 0, axis=0).astype(bool)
+    Gamma = onp.where(positive, onp.minimum.accumulate(onp.where(positive, Gamma, onp.inf), axis=0), 0.)
+    tau = -1. + 2.*Gamma.sum(axis=0)
+    return M/onp.maximum(tau, 1./M)
+
+def lag_window_weights(lag_window, bw, num_lags):
+    '''
+    Weights of the lag window `lag_window` at lags 0, ..., `num_lags`-1 for each of the bandwidths in the vector `bw`. Returns a (num_lags x len(bw)) matrix
+    '''
+    assert lag_window in LAG_WINDOWS
+    h = onp.arange(num_lags).reshape(-1, 1)
+    bw = onp.asarray(bw, dtype=float).reshape(1, -1)
+    if lag_window == 'bartlett':
+        z = h/(bw+1)
+        w = onp.where(h <= onp.floor(bw), 1. - z, 0.)
+    elif lag_window == 'parzen':
+        z = h/(bw+1)
+        w = onp.where(h <= onp.floor(bw), onp.where(z <= 0.5, 1. - 6.*z**2*(1.-z), 2.*(1.-z)**3), 0.)
+    elif lag_window == 'qs':
+        with onp.errstate(divide='ignore', invalid='ignore'):
+            x = 6.*onp.pi*(h/bw)/5.
+            w = 3./x**2 * (onp.sin(x)/x - onp.cos(x))
+        w[0, :] = 1.
+        w[1:, bw.flatten() == 0] = 0.
+    return w
+
+def long_run_variance(g, lag_window='bartlett', bandwidth=None, force_int=False, center=True):
+    '''
+    Lag window estimate of the long-run variance of each column of `g`, computed for all columns at once from FFT autocovariances. Matches arch.covariance.kernel (`lag_window` = 'bartlett', 'parzen' or 'qs')
+    If `bandwidth`=None, selects the bandwidth of each column automatically (Andrews 1991; Newey and West 1994)
+    '''
+    assert lag_window in LAG_WINDOWS
+    if len(g.shape) == 1:
+        g = g.reshape(-1, 1)
+    M, p = g.shape
+    if bandwidth == 0:
+        if center == True:
+            return g.var(axis=0)
+        return (g**2).sum(axis=0)/M
+    c, q, rate = LAG_WINDOWS[lag_window]
+    if bandwidth is None or lag_window == 'qs':
+        max_lag = M-1
+    else:
+        max_lag = min(int(onp.ceil(bandwidth)), M-1)
+    acov = autocovariance(g, max_lag=max_lag, center=center)
+
+    if bandwidth is None:
+        n_pilot = min(int(onp.ceil(4 * ((M / 100) ** rate))), M-1)
+        j = onp.arange(n_pilot+1).reshape(-1, 1)
+        sig = acov[:(n_pilot+1), :] * onp.where(j == 0, 1., 2.)
+        alpha_q = ((j**q * sig).sum(axis=0)/sig.sum(axis=0))**2
+        bw = c * (alpha_q * M) ** (1 / (2 * q + 1))
+        if force_int == True:
+            bw = onp.ceil(bw)
+        bw = onp.minimum(bw, M - 1.)
+    else:
+        bw = onp.full(p, float(bandwidth))
+    if force_int == True:
+        bw = onp.ceil(bw)
+
+    if lag_window == 'qs':
+        num_lags = M
+    else:
+        num_lags = min(int(bw.max()) + 1, max_lag + 1)
+    w = lag_window_weights(lag_window, bw, num_lags)
+    return 2.*(w * acov[:num_lags, :]).sum(axis=0) - acov[0, :]
+
+def geweke_se2(g, L=None, force_int_L=False, chain_ids=None, lag_window='bartlett'):
+    '''
+    Calculate the squared standard error of the estimate of E[`g`] (Geweke 1999, 3.7-8), vectorized over the columns of `g` (see `long_run_variance`)
     If `L`=None, automatically selects bandwidth for the lag window based on an asymptotic MSE criterion (Andrews 1991). This assumes that `g` is fourth-moment stationary and the autocovariances are L1-summable
+    If `chain_ids` is given, the rows of `g` come from independent chains. The long-run variance is then pooled across chains, each chain using a window of `L` scaled by its share of the samples and centered at the pooled mean
     '''
     if len(g.shape) == 1:
         g = g.reshape(-1, 1)
     M = g.shape[0]
+    if chain_ids is not None:
+        chain_ids = onp.asarray(chain_ids).flatten()
+        assert chain_ids.shape[0] == M
+        g_centered = g - g.mean(axis=0)
+        v = onp.zeros(g.shape[1])
+        for c in onp.unique(chain_ids):
+            g_c = g_centered[chain_ids == c, :]
+            M_c = g_c.shape[0]
+            if L is not None:
+                bw = max(L*M_c/M-1, 0)
+            else:
+                bw = None
+            v += M_c * long_run_variance(g_c, lag_window=lag_window, bandwidth=bw, force_int=force_int_L, center=False)
+        v /= M**2
+        return v
     if L is not None:
         bw = max(L-1, 0)
     else:
         bw = None
-    v = onp.array([float(arch.covariance.kernel.Bartlett(g[:, j], bandwidth=bw,
-                                  force_int=force_int_L).cov.long_run) for j in range(g.shape[1])])
+    v = long_run_variance(g, lag_window=lag_window, bandwidth=bw, force_int=force_int_L)
     v /= M
     return v
 
-def geweke_test(g_mc, g_sc, alpha=0.05, l=None, test_correction='bh'):
+def geweke_se2_arch(g, L=None, force_int_L=False):
+    '''
+    Reference implementation of `geweke_se2` with the Bartlett lag window, fitting one arch.covariance.kernel.Bartlett per column; depends on arch
+    '''
+    if len(g.shape) == 1:
+        g = g.reshape(-1, 1)
+    M = g.shape[0]
+    if L is not None:
+        bw = max(L-1, 0)
+    else:
+        bw = None
+    # The long-run covariance is a (1 x 1) matrix in recent versions of arch
+    v = onp.array([onp.asarray(arch.covariance.kernel.Bartlett(g[:, j], bandwidth=bw,
+                                  force_int=force_int_L).cov.long_run).item() for j in range(g.shape[1])])
+    v /= M
+    return v
+
+def geweke_test(g_mc, g_sc, alpha=0.05, l=None, test_correction='bh', chain_ids_sc=None, lag_window='bartlett'):
     '''
     Run Geweke test (Geweke 2004) on marginal-conditional and successive-conditional test function arrays `g_mc` and `g_sc`, each row corresponding to a sample
     Uses a maximum window size of `l`*M to estimate of the squared standard error of E[g_sc], where M is the number of successive-conditional samples
     Example values of `l` are 0.04, 0.08, 0.15. `l`=None for automatic lag window bandwidth selection (Andrews 1991)
     `test_correction` corrects for multiple testing if set to 'b' (for Bonferroni) or 'bh' (for Benjamini-Hochberg)
+    `chain_ids_sc` gives the chain of each row of `g_sc` when it comes from several independent successive-conditional chains (see `model_sampler.sample_sc`)
+    `g_mc` can also be a `running_moments` accumulated over chunks of marginal-conditional test functions
+    `lag_window` = 'bartlett', 'parzen' or 'qs' is used to estimate the squared standard error of E[g_sc]
+    `g_mc` and `g_sc` can be lazy test function views (see `model_sampler.test_functions`), which are processed one block of columns at a time
     '''
     
     assert test_correction in ['b', 'bh']
-    num_tests = g_mc.shape[1]
     
-    if len(g_mc.shape) == 1 or len(g_sc.shape) == 1:
-        g_mc = g_mc.reshape(-1, 1)
+    if len(g_sc.shape) == 1:
         g_sc = g_sc.reshape(-1, 1)
-    assert len(g_mc.shape) == 2 and len(g_sc.shape) == 2
-    assert g_mc.shape[1] == g_sc.shape[1]
-    
-    mean_mc = g_mc.mean(axis=0)
-    se2_mc = geweke_se2(g_mc, L=0)
+    if isinstance(g_mc, running_moments):
+        mean_mc = g_mc.mean
+        se2_mc = g_mc.var/g_mc.n
+    else:
+        if len(g_mc.shape) == 1:
+            g_mc = g_mc.reshape(-1, 1)
+        assert len(g_mc.shape) == 2
+        mean_mc = []
+        se2_mc = []
+        for g in iterColumnBlocks(g_mc):
+            mean_mc.append(g.mean(axis=0))
+            se2_mc.append(geweke_se2(g, L=0))
+        mean_mc = onp.hstack(mean_mc)
+        se2_mc = onp.hstack(se2_mc)
+    assert len(g_sc.shape) == 2
+    assert mean_mc.shape[0] == g_sc.shape[1]
 
     M_sc = float(g_sc.shape[0])
-    mean_sc = g_sc.mean(axis=0)
     if l is not None:
         L_sc = l*M_sc
     else:
         L_sc = None
-    se2_sc = geweke_se2(g_sc, L=L_sc)
+    mean_sc = []
+    se2_sc = []
+    for g in iterColumnBlocks(g_sc):
+        mean_sc.append(g.mean(axis=0))
+        se2_sc.append(geweke_se2(g, L=L_sc, chain_ids=chain_ids_sc, lag_window=lag_window))
+    mean_sc = onp.hstack(mean_sc)
+    se2_sc = onp.hstack(se2_sc)
 
     test_statistic = (mean_mc - mean_sc)/onp.sqrt(se2_mc + se2_sc)
     p_value = 2.*(1-scipy.stats.norm.cdf(abs(test_statistic)))
-        
-    if test_correction == 'b':
-        threshold = scipy.stats.norm.ppf(1.-alpha/(2.)) # asymptotic
-        alpha /= num_tests
-        result = p_value <= alpha
-    elif test_correction == 'bh':
-        threshold = None
-        rank = onp.empty_like(p_value)
-        rank[onp.argsort(p_value)] = onp.arange(1, len(p_value)+1)
-        under = p_value <= rank/num_tests * alpha
-        if under.sum() > 0:
-          rank_max = rank[under].max()
-        else:
-          rank_max = 0
-        result = rank <= rank_max
+    result, threshold = multipleTestCorrection(p_value, alpha, test_correction)
     
     return {'result': result, 'p_value': p_value, 'test_statistic': test_statistic, 'critical_value': threshold, 'test_correction': test_correction}
 
+class running_moments(object):
+    def __init__(self, chunks=None):
+        '''
+        Running column means and (biased) variances of a stream of (n x p) arrays, in O(p) memory
+        `chunks` = optional iterable of arrays to accumulate
+        '''
+        self._n = 0
+        self._mean = None
+        self._M2 = None
+        if chunks is not None:
+            for x in chunks:
+                self.update(x)
+        pass
+
+    @property
+    def n(self):
+        return self._n
+
+    @property
+    def mean(self):
+        return self._mean
+
+    @property
+    def var(self):
+        return self._M2/self._n
+
+    def update(self, x):
+        '''
+        Add the rows of `x`
+        '''
+        if len(x.shape) == 1:
+            x = x.reshape(-1, 1)
+        n = x.shape[0]
+        if n == 0:
+            return self
+        mean = x.mean(axis=0)
+        M2 = ((x - mean)**2).sum(axis=0)
+        return self._combine(n, mean, M2)
+
+    def merge(self, other):
+        '''
+        Add the moments accumulated in the `running_moments` object `other`
+        '''
+        if other.n == 0:
+            return self
+        return self._combine(other.n, other.mean, other._M2)
+
+    def _combine(self, n, mean, M2):
+        # Chan, Golub and LeVeque's pairwise update
+        if self._n == 0:
+            self._n, self._mean, self._M2 = n, mean.copy(), M2.copy()
+        else:
+            n_total = self._n + n
+            delta = mean - self._mean
+            self._mean = self._mean + delta * n/n_total
+            self._M2 = self._M2 + M2 + delta**2 * self._n*n/n_total
+            self._n = n_total
+        return self
+
+class geweke_accumulator(object):
+    def __init__(self, num_batches=32):
+        '''
+        Online Geweke test (Geweke 2004) on rows of marginal-conditional and successive-conditional test functions, added as they are produced
+        The squared standard error of E[g_sc] is estimated by batch means over between `num_batches` and 2*`num_batches` consecutive batches, whose size doubles whenever the batch buffer fills up. Memory is O(`num_batches` * p) regardless of the number of samples
+        '''
+        assert num_batches >= 2
+        self._num_batches = int(num_batches)
+        self._mc = running_moments()
+        self._sc = running_moments()
+        self._batch_size = 1
+        self._batch_means = None
+        self._num_full = 0
+        self._partial_sum = None
+        self._partial_n = 0
+        pass
+
+    @property
+    def n_mc(self):
+        return self._mc.n
+
+    @property
+    def n_sc(self):
+        return self._sc.n
+
+    def update(self, g_mc=None, g_sc=None):
+        '''
+        Add rows of marginal-conditional test functions `g_mc` and/or successive-conditional test functions `g_sc`; `g_sc` rows must arrive in chain order
+        '''
+        if g_mc is not None:
+            self._mc.update(g_mc)
+        if g_sc is not None:
+            if len(g_sc.shape) == 1:
+                g_sc = g_sc.reshape(-1, 1)
+            self._sc.update(g_sc)
+            self._update_batches(g_sc)
+        return self
+
+    def _update_batches(self, g):
+        p = g.shape[1]
+        if self._batch_means is None:
+            self._batch_means = onp.empty([2*self._num_batches, p])
+            self._partial_sum = onp.zeros(p)
+        i = 0
+        n = g.shape[0]
+        while i < n:
+            # Complete the current batch
+            b = self._batch_size
+            take = min(b - self._partial_n, n - i)
+            self._partial_sum += g[i:(i+take), :].sum(axis=0)
+            self._partial_n += take
+            i += take
+            if self._partial_n == b:
+                self._batch_means[self._num_full, :] = self._partial_sum/b
+                self._num_full += 1
+                self._partial_sum[:] = 0.
+                self._partial_n = 0
+                # Add as many whole batches as fit in the buffer
+                num_new = min((n - i)//b, 2*self._num_batches - self._num_full)
+                if num_new > 0:
+                    self._batch_means[self._num_full:(self._num_full+num_new), :] = g[i:(i+num_new*b), :].reshape(num_new, b, p).mean(axis=1)
+                    self._num_full += num_new
+                    i += num_new*b
+            if self._num_full == 2*self._num_batches:
+                # Merge adjacent batches and double the batch size
+                self._batch_means[:self._num_batches, :] = (self._batch_means[0::2, :] + self._batch_means[1::2, :])/2.
+                self._num_full = self._num_batches
+                self._batch_size *= 2
+        pass
+
+    def se2_sc(self):
+        '''
+        Batch-means estimate of the squared standard error of E[g_sc]
+        '''
+        assert self._num_full >= 2
+        batch_means = self._batch_means[:self._num_full, :]
+        return batch_means.var(axis=0, ddof=1)/self._num_full
+
+    def test(self, alpha=0.05, test_correction='bh'):
+        '''
+        Run the Geweke test on the samples added so far. Same output as `geweke_test`
+        `test_correction` corrects for multiple testing if set to 'b' (for Bonferroni) or 'bh' (for Benjamini-Hochberg)
+        '''
+        assert test_correction in ['b', 'bh']
+        assert self._mc.n > 0
+        se2_mc = self._mc.var/self._mc.n
+        se2_sc = self.se2_sc()
+        test_statistic = (self._mc.mean - self._sc.mean)/onp.sqrt(se2_mc + se2_sc)
+        p_value = 2.*(1-scipy.stats.norm.cdf(abs(test_statistic)))
+        result, threshold = multipleTestCorrection(p_value, alpha, test_correction)
+        return {'result': result, 'p_value': p_value, 'test_statistic': test_statistic, 'critical_value': threshold, 'test_correction': test_correction}
+
 def prob_plot(x, y, plot_type='PP', step = 0.005):
     '''
     Generate Geweke P-P plot (Grosse and Duvenaud 2014) for sample vectors x, y. Can also generate Q-Q plots.
@@ -479,23 +1496,372 @@ def prob_plot(x, y, plot_type='PP', step = 0.005):
 ############################## MMD test ###############################
 #######################################################################
 
-def mmd_test(X, Y, kernel=rbf_kernel, alpha=0.05, null_samples=100, kernel_learn_method=None, mmd_type='unbiased', rng=None, X_train=None, Y_train=None, **kwargs):
+class pooled_gram_matrix(object):
+    def __init__(self, K, XY, n_X, packed=False, max_bytes=None, storage='memory', storage_dir=None, dtype=None):
+        '''
+        Kernel matrix of the pooled sample `XY` = [X; Y], where X is the first `n_X` rows, for the kernel object `K` (with learned parameters)
+        The matrix is symmetric by construction: only the tiles on and above the diagonal are evaluated (via `K.f_kernel_matrix`, falling back to `K.eval` if unsupported), and if `packed`=True only the upper triangle is stored
+        Row sums, diagonal and squared sums of the XX, YY and XY blocks are computed once at construction
+        `max_bytes` bounds the working memory of a tile (default `PAIRWISE_MAX_BYTES`)
+        `storage`='memmap' keeps the matrix out of core in a memory-mapped file in `storage_dir` (default the system temporary directory), removed by `close`. All statistics then stream over row blocks, so only about `max_bytes` of the matrix is in memory at a time; kernels that only support `eval` are evaluated tile by tile through `f_kernel_pairs`
+        `dtype`='float32' stores the matrix (and computes its products) in single precision, at half the memory; the sums and quadratic forms are still accumulated in double precision
+        '''
+        assert storage in ['memory', 'memmap']
+        N = XY.shape[0] if hasattr(XY, 'shape') else len(XY)
+        self._N = N
+        self._n_X = int(n_X)
+        self._n_Y = N - int(n_X)
+        self._packed = packed
+        self._max_bytes = PAIRWISE_MAX_BYTES if max_bytes is None else max_bytes
+        self._storage = storage
+        self._path = None
+        self._dtype = onp.dtype(onp.float64 if dtype is None else dtype)
+        if packed == True:
+            # Rows of the packed matrix are scattered, so it is kept in memory
+            assert storage == 'memory'
+            i = onp.arange(N)
+            self._offsets = i*N - i*(i-1)//2
+            self._data = onp.empty(N*(N+1)//2, dtype=self._dtype)
+        elif storage == 'memmap':
+            fd, self._path = tempfile.mkstemp(suffix='.gram', dir=storage_dir)
+            os.close(fd)
+            self._data = onp.memmap(self._path, dtype=self._dtype, mode='w+', shape=(N, N))
+        else:
+            self._data = onp.empty([N, N], dtype=self._dtype)
+        self._fill(K, XY)
+        if storage == 'memmap':
+            self._data.flush()
+        self._summarize()
+        pass
+
+    def close(self):
+        '''
+        Release the memory-mapped file, if any
+        '''
+        if self._path is not None:
+            self._data = None
+            os.remove(self._path)
+            self._path = None
+        pass
+
+    def __del__(self):
+        if getattr(self, '_path', None) is not None:
+            self.close()
+        pass
+
+    def __getstate__(self):
+        # A memory-mapped matrix is sent by the name of its file, reopened read-only without taking ownership: only the creator removes the file
+        state = self.__dict__.copy()
+        if self._storage == 'memmap' and self._data is not None:
+            state['_data'] = None
+            state['_file'] = self._data.filename
+            state['_path'] = None
+        return state
+
+    def __setstate__(self, state):
+        path = state.pop('_file', None)
+        self.__dict__.update(state)
+        if path is not None:
+            self._data = onp.memmap(path, dtype=self._dtype, mode='r', shape=(self._N, self._N))
+        pass
+
+    def _fill(self, K, XY):
+        N = self._N
+        T = max(1, int(onp.sqrt(self._max_bytes/self._dtype.itemsize)))
+        for start_r in range(0, N, T):
+            rows = slice(start_r, min(start_r + T, N))
+            A = XY[rows]
+            for start_c in range(start_r, N, T):
+                cols = slice(start_c, min(start_c + T, N))
+                B = A if start_c == start_r else XY[cols]
+                K_tile = K.f_kernel_matrix(A, B)
+                if K_tile is None and self._storage == 'memmap':
+                    K_tile = K._kernel_block(A, B)
+                if K_tile is None:
+                    # Kernel can't evaluate arbitrary blocks
+                    self._set_dense(K.eval())
+                    return
+                self._set_tile(rows, cols, K_tile)
+        pass
+
+    def _set_dense(self, K_full):
+        if self._packed == True:
+            for rows in pairwiseRowBlocks(self._N, self._N, self._max_bytes):
+                cols = slice(rows.start, self._N)
+                self._set_tile(rows, cols, K_full[rows, cols])
+        else:
+            self._data[:, :] = K_full
+        pass
+
+    def _set_tile(self, rows, cols, K_tile):
+        if self._packed == True:
+            # Only the entries on and above the diagonal are stored, in bands of rows as in `_packed_block`
+            I, J = onp.arange(rows.start, rows.stop), onp.arange(cols.start, cols.stop)
+            band = max(1, PACKED_BAND_ENTRIES // len(J))
+            for a in range(0, len(I), band):
+                I_b = I[a:(a+band)]
+                start = onp.searchsorted(J, I_b[0])
+                index = onp.add.outer(self._offsets[I_b] - I_b, J[start:])
+                K_b = K_tile[a:(a+band), start:]
+                if start < len(J) and J[start] <= I_b[-1]:
+                    upper = onp.subtract.outer(I_b, J[start:]) <= 0
+                    index, K_b = index[upper], K_b[upper]
+                self._data[index] = K_b
+        else:
+            self._data[rows, cols] = K_tile
+            if cols.start != rows.start:
+                self._data[cols, rows] = K_tile.T
+        pass
+
+    def _packed_block(self, rows, cols):
+        # Block `rows` x `cols` (slices) of the full matrix from the packed upper triangle, where entry (i, j), i <= j, is at _offsets[i] - i + j
+        # Within a band of rows, the columns left of the band are read by symmetry, those right of it directly, and only the columns crossing the diagonal need both. Bands keep the index matrices in cache
+        I = onp.arange(self._N)[rows]
+        J = onp.arange(self._N)[cols]
+        out = onp.empty([len(I), len(J)], dtype=self._dtype)
+        band = max(1, PACKED_BAND_ENTRIES // max(len(J), 1))
+        for a in range(0, len(I), band):
+            I_b = I[a:(a+band)]
+            start = onp.searchsorted(J, I_b[0])
+            stop = onp.searchsorted(J, I_b[-1], side='right')
+            J_l, J_d, J_u = J[:start], J[start:stop], J[stop:]
+            out[a:(a+band), :start] = self._data[onp.add.outer(I_b, self._offsets[J_l] - J_l)]
+            out[a:(a+band), stop:] = self._data[onp.add.outer(self._offsets[I_b] - I_b, J_u)]
+            if stop > start:
+                lo = onp.minimum.outer(I_b, J_d)
+                out[a:(a+band), start:stop] = self._data[onp.add.outer(I_b, J_d) + self._offsets[lo] - 2*lo]
+        return out
+
+    def iter_row_blocks(self):
+        '''
+        Yield (row slice, rows of the full matrix) in consecutive blocks
+        '''
+        for rows in pairwiseRowBlocks(self._N, self._N, self._max_bytes):
+            if self._packed == True:
+                yield rows, self._packed_block(rows, slice(None))
+            else:
+                yield rows, self._data[rows, :]
+
+    def _summarize(self):
+        n_X, N = self._n_X, self._N
+        self._diag = onp.empty(N)
+        self._row_sums_X = onp.empty(N)
+        self._row_sums_Y = onp.empty(N)
+        self._sq_row_sums_X = onp.empty(N)
+        self._sq_row_sums_Y = onp.empty(N)
+        for rows, R in self.iter_row_blocks():
+            self._diag[rows] = R[onp.arange(R.shape[0]), onp.arange(rows.start, rows.stop)]
+            self._row_sums_X[rows] = R[:, :n_X].sum(axis=1, dtype=onp.float64)
+            self._row_sums_Y[rows] = R[:, n_X:].sum(axis=1, dtype=onp.float64)
+            self._sq_row_sums_X[rows] = (R[:, :n_X]**2).sum(axis=1, dtype=onp.float64)
+            self._sq_row_sums_Y[rows] = (R[:, n_X:]**2).sum(axis=1, dtype=onp.float64)
+        self.sum_XX = self._row_sums_X[:n_X].sum()
+        self.sum_YY = self._row_sums_Y[n_X:].sum()
+        self.sum_XY = self._row_sums_Y[:n_X].sum()
+        self.trace_XX = self._diag[:n_X].sum()
+        self.trace_YY = self._diag[n_X:].sum()
+        self.sq_sum_XX = self._sq_row_sums_X[:n_X].sum()
+        self.sq_sum_YY = self._sq_row_sums_Y[n_X:].sum()
+        self.sq_sum_XY = self._sq_row_sums_Y[:n_X].sum()
+        pass
+
+    @property
+    def n_X(self):
+        return self._n_X
+
+    @property
+    def n_Y(self):
+        return self._n_Y
+
+    @property
+    def diag(self):
+        return self._diag
+
+    @property
+    def row_sums_XX(self):
+        return self._row_sums_X[:self._n_X]
+
+    @property
+    def row_sums_YY(self):
+        return self._row_sums_Y[self._n_X:]
+
+    @property
+    def row_sums_XY(self):
+        return self._row_sums_Y[:self._n_X]
+
+    @property
+    def col_sums_XY(self):
+        return self._row_sums_X[self._n_X:]
+
+    @property
+    def row_sums(self):
+        return self._row_sums_X + self._row_sums_Y
+
+    def matmul(self, V):
+        '''
+        Product K V with an (N x k) matrix `V`, computed over row blocks in the storage dtype
+        '''
+        V = onp.asarray(V, dtype=self._dtype)
+        out = onp.empty([self._N, V.shape[1]], dtype=self._dtype)
+        for rows, R in self.iter_row_blocks():
+            onp.matmul(R, V, out=out[rows, :])
+        return out
+
+    def quadratic_forms(self, V):
+        '''
+        Quadratic forms v'Kv of the columns v of the (N x k) matrix `V`, accumulated in double precision
+        '''
+        return (V * self.matmul(V)).sum(axis=0, dtype=onp.float64)
+
+    @property
+    def dense(self):
+        '''
+        Full (N x N) matrix; a view unless packed
+        '''
+        if self._packed == True:
+            return onp.vstack([R for _, R in self.iter_row_blocks()])
+        return self._data
+
+    def block(self, rows, cols):
+        '''
+        Block of the full matrix; a view unless packed
+        '''
+        if self._packed == True:
+            return self._packed_block(rows, cols)
+        return self._data[rows, cols]
+
+    def combined(self):
+        '''
+        (n x n) matrix H = K_XX + K_YY - K_XY - K_YX for equal sample sizes n, so that v'Kv = w'Hw for v = [w; -w] (see `mmd_wb`)
+        '''
+        assert self._n_X == self._n_Y
+        H = self.K_XX + self.K_YY
+        K_XY = self.K_XY
+        H -= K_XY
+        H -= K_XY.T
+        return H
+
+    @property
+    def K_XX(self):
+        return self.block(slice(0, self._n_X), slice(0, self._n_X))
+
+    @property
+    def K_YY(self):
+        return self.block(slice(self._n_X, self._N), slice(self._n_X, self._N))
+
+    @property
+    def K_XY(self):
+        return self.block(slice(0, self._n_X), slice(self._n_X, self._N))
+
+class lowrank_gram_matrix(pooled_gram_matrix):
+    def __init__(self, Phi, n_X):
+        '''
+        Kernel matrix K = Phi Phi' of the pooled sample [X; Y], where X is the first `n_X` rows, given the (N x D) feature matrix `Phi` (see `kernel.features`)
+        Same interface as `pooled_gram_matrix`, but K is never formed: the sums and the products K V cost O(N D) (the squared sums O(N D^2)), so the MMD statistics and their permutation and wild bootstrap nulls scale linearly in N
+        Products are computed in the dtype of `Phi`, and the sums accumulated in double precision over row blocks
+        '''
+        N, D = Phi.shape
+        self._Phi = Phi
+        self._N = N
+        self._n_X = int(n_X)
+        self._n_Y = N - int(n_X)
+        self._packed = False
+        self._max_bytes = PAIRWISE_MAX_BYTES
+        self._storage = 'memory'
+        self._path = None
+        self._dtype = Phi.dtype
+        s_X = Phi[:n_X].sum(axis=0, dtype=onp.float64)
+        s_Y = Phi[n_X:].sum(axis=0, dtype=onp.float64)
+        self._diag = onp.empty(N)
+        self._row_sums_X = onp.empty(N)
+        self._row_sums_Y = onp.empty(N)
+        C_XX, C_YY = onp.zeros([D, D]), onp.zeros([D, D])
+        for rows in pairwiseRowBlocks(N, D, self._max_bytes):
+            P = Phi[rows].astype(onp.float64, copy=False)
+            self._diag[rows] = (P**2).sum(axis=1)
+            self._row_sums_X[rows] = P @ s_X
+            self._row_sums_Y[rows] = P @ s_Y
+            k = min(max(self._n_X - rows.start, 0), P.shape[0])
+            C_XX += P[:k].T @ P[:k]
+            C_YY += P[k:].T @ P[k:]
+        self.sum_XX = self._row_sums_X[:n_X].sum()
+        self.sum_YY = self._row_sums_Y[n_X:].sum()
+        self.sum_XY = self._row_sums_Y[:n_X].sum()
+        self.trace_XX = self._diag[:n_X].sum()
+        self.trace_YY = self._diag[n_X:].sum()
+        # sum_ij <phi_i, psi_j>^2 = tr(C_X C_Y)
+        self.sq_sum_XX = (C_XX**2).sum()
+        self.sq_sum_YY = (C_YY**2).sum()
+        self.sq_sum_XY = (C_XX * C_YY).sum()
+        self._sq_row_sums_X = None
+        self._sq_row_sums_Y = None
+        pass
+
+    @property
+    def features(self):
+        return self._Phi
+
+    def iter_row_blocks(self):
+        for rows in pairwiseRowBlocks(self._N, self._N, self._max_bytes):
+            yield rows, self._Phi[rows] @ self._Phi.T
+
+    def matmul(self, V):
+        V = onp.asarray(V, dtype=self._dtype)
+        return self._Phi @ (self._Phi.T @ V)
+
+    def quadratic_forms(self, V):
+        V = onp.asarray(V, dtype=self._dtype)
+        return ((self._Phi.T @ V)**2).sum(axis=0, dtype=onp.float64)
+
+    @property
+    def dense(self):
+        return self._Phi @ self._Phi.T
+
+    def block(self, rows, cols):
+        return self._Phi[rows] @ self._Phi[cols].T
+
+def gramMatrix(K, XY, n_X, nystroem_landmarks=None, nystroem_method='uniform', rng=None, storage='memory', storage_dir=None, dtype=None):
+    '''
+    Kernel matrix of the pooled sample `XY` for the MMD tests: a `lowrank_gram_matrix` of Nystrom features with `nystroem_landmarks` landmarks if given (see `kernel.nystroem_features`), or of the kernel's own feature map (see `kernel.features`), else a `pooled_gram_matrix` stored in `storage` (in `storage_dir`) in `dtype` (default double)
+    '''
+    if nystroem_landmarks is not None:
+        return lowrank_gram_matrix(K.nystroem_features(XY, nystroem_landmarks, method=nystroem_method, rng=rng), n_X)
+    Phi = K.features(XY)
+    if Phi is not None:
+        return lowrank_gram_matrix(Phi, n_X)
+    return pooled_gram_matrix(K, XY, n_X, storage=storage, storage_dir=storage_dir, dtype=dtype)
+
+def mmd_test(X, Y, kernel=rbf_kernel, alpha=0.05, null_samples=100, kernel_learn_method=None, mmd_type='unbiased', rng=None, X_train=None, Y_train=None, block_size=32, executor=None, null_chunk_size=None, nystroem_landmarks=None, nystroem_method='uniform', gram_storage='memory', gram_dir=None, dtype=None, **kwargs):
     '''
     Quadratic/Linear time MMD test
+    `mmd_type`='block' runs the block MMD test with blocks of `block_size` rows (see `mmd_accumulator`)
+    The permutation null is computed in chunks of `null_chunk_size` (default `MAP_CHUNK_SIZE`) replicates with their own seeds, in parallel on `executor` if given (see `mapChunks`). Without an executor the chunks share the matrix products of `mmdPermutationNull`, so it takes as few passes over the kernel matrix as its memory bound allows. The result doesn't depend on the executor
+    If `nystroem_landmarks` is given, the quadratic time tests use a Nystrom approximation of the kernel matrix in O(n `nystroem_landmarks`) (see `kernel.nystroem_features`); the median heuristic of RBF kernels then defaults to a random subset of pairs (see `subsampledMedianKwargs`)
+    `gram_storage`='memmap' keeps the exact kernel matrix in a memory-mapped file in `gram_dir` (see `pooled_gram_matrix`); each chunk of the permutation null is then one pass over the file. The median heuristic then uses a random subset of pairs, as with `nystroem_landmarks`
+    `dtype`='float32' computes and stores the kernel matrix in single precision (the kernel must accept a `dtype` argument); the statistics are still accumulated in double precision. See `mmd_dtype_check` for the resulting error
+    Lazy test function views are materialized
     '''
+    X = onp.asarray(X)
+    Y = onp.asarray(Y)
     assert X.shape[1] == Y.shape[1] and len(X.shape) == 2 and len(Y.shape) == 2
-    assert mmd_type in ['biased', 'unbiased', 'linear']
+    assert mmd_type in ['biased', 'unbiased', 'linear', 'block']
     assert kernel_learn_method is None or kernel_learn_method in ['median_heuristic']
-    if kernel_learn_method is None and (kernel == rbf_kernel):
+    if kernel_learn_method is None and issubclass(kernel, rbf_kernel):
         kernel_learn_method = 'median_heuristic'
     
     if rng is None:
         rng = onp.random.default_rng()
+    if dtype is not None:
+        X = X.astype(dtype, copy=False)
+        Y = Y.astype(dtype, copy=False)
+        kwargs['dtype'] = dtype
+    if nystroem_landmarks is not None or gram_storage == 'memmap':
+        kwargs = subsampledMedianKwargs(kernel, kwargs)
     
     XY = onp.vstack([X,Y])
     K = kernel(XY, XY, **kwargs)
     
-    if kernel in [rbf_kernel]:
+    if issubclass(kernel, rbf_kernel):
         K.learn(method=kernel_learn_method)
     elif kernel == linear_kernel:
         pass
@@ -505,45 +1871,31 @@ def mmd_test(X, Y, kernel=rbf_kernel, alpha=0.05, null_samples=100, kernel_learn
     if mmd_type == 'linear':
         assert X.shape == Y.shape
         n, p = X.shape
-        f_kernel = K.f_kernel
-
         # Calculate test statistic
-        test_statistic, var = mmd_l(X, Y, f_kernel, return_2nd_moment=True)
+        test_statistic, var = mmd_l(X, Y, return_2nd_moment=True, f_kernel_pairs=K.f_kernel_pairs)
         var -= test_statistic**2
         scale = onp.sqrt(2.*var/n)
         p_value = scipy.stats.norm.sf(test_statistic, scale=scale)
         result = p_value <= alpha
         threshold = scipy.stats.norm.ppf(1.-alpha, scale=scale)
+    elif mmd_type == 'block':
+        return mmd_accumulator(K, mmd_type='block', block_size=block_size).update(X, Y).test(alpha=alpha)
     else:
         
         # Calculate null distribution       
-        K_XYXY = K.eval()
         n_X, p = X.shape
         n_Y = Y.shape[0]
-        null_distr = onp.zeros(null_samples)
-        for i in range(null_samples):
-            ind = rng.permutation(int(n_X+n_Y))
-            ind_X = ind[:n_X]
-            ind_Y = ind[n_Y:]
-
-            K_XX = K_XYXY[ind_X, :][:, ind_X]
-            K_YY = K_XYXY[ind_Y, :][:, ind_Y]
-            K_XY = K_XYXY[ind_X, :][:, ind_Y]
-            
+        gram = gramMatrix(K, XY, n_X, nystroem_landmarks=nystroem_landmarks, nystroem_method=nystroem_method, rng=rng, storage=gram_storage, storage_dir=gram_dir, dtype=dtype)
+        try:
+            null_distr = mapChunks(_mmdNullChunk, null_samples, null_chunk_size, rng, args=(gram, mmd_type), executor=executor, f_stacked=_mmdNullChunks)
+
+            # Calculate test statistic
             if mmd_type == 'unbiased':
-                null_distr[i] = mmd_u(K_XX=K_XX, K_YY=K_YY, K_XY=K_XY)
+                test_statistic = mmd_u(gram=gram)
             elif mmd_type == 'biased':
-                null_distr[i] = mmd_v(K_XX=K_XX, K_YY=K_YY, K_XY=K_XY)
-
-        # Calculate test statistic
-        K_XX = K_XYXY[:n_X, :][:, :n_X]
-        K_YY = K_XYXY[n_X:, :][:, n_X:]
-        K_XY = K_XYXY[:n_X, :][:, n_X:]
-
-        if mmd_type == 'unbiased':
-            test_statistic = mmd_u(K_XX=K_XX, K_YY=K_YY, K_XY=K_XY)
-        elif mmd_type == 'biased':
-            test_statistic = mmd_v(K_XX=K_XX, K_YY=K_YY, K_XY=K_XY)    
+                test_statistic = mmd_v(gram=gram)
+        finally:
+            gram.close()
 
         threshold = onp.quantile(null_distr, 1.-alpha)
         result = test_statistic >= threshold
@@ -551,10 +1903,71 @@ def mmd_test(X, Y, kernel=rbf_kernel, alpha=0.05, null_samples=100, kernel_learn
     
     return {'result':result, 'p_value':p_value, 'test_statistic':test_statistic, 'critical_value':threshold, 'kernel_param':K.params}
 
-def mmd_u(K_XX, K_YY, K_XY, normalize=True):
+def mmdFromSums(n_X, n_Y, sum_XX, sum_YY, sum_XY, trace_XX=None, trace_YY=None, normalize=True):
+    '''
+    (Squared) MMD from the sums of the kernel matrix blocks of samples of sizes `n_X` and `n_Y`; works elementwise on arrays of sums
+    The u-statistic if the traces `trace_XX` and `trace_YY` are given, else the v-statistic. `normalize`=True scales as in `mmd_u` and `mmd_v`
+    '''
+    z = 1.
+    if normalize == True:
+        z = n_X if n_X == n_Y else n_X * n_Y / (n_X + n_Y)
+    if trace_XX is None:
+        return z*(sum_XX/n_X**2 + sum_YY/n_Y**2 - 2.*sum_XY/(n_X*n_Y))
+    return z*(1./(n_X*(n_X-1)) * (sum_XX - trace_XX) + 1./(n_Y*(n_Y-1)) * (sum_YY - trace_YY) - 2.*sum_XY/(n_X*n_Y))
+
+def mmdPermutationNull(gram, null_samples, mmd_type='unbiased', rng=None):
+    '''
+    Permutation null distribution of the (normalized) MMD statistic from the `pooled_gram_matrix` `gram`, without copying sub-matrices
+    With a the indicator of the permuted X sample, the block sums are a'Ka (XX), a'K1 - a'Ka (XY) and 1'K1 - 2a'K1 + a'Ka (YY), and the XX trace is a'diag(K). The quadratic forms of a chunk of permutations take one matrix product
+    `null_samples` and `rng` can also be lists of counts and generators: the first count of permutations is drawn with the first generator and so on, sharing the matrix products (see `mapChunks`)
+    '''
+    assert mmd_type in ['biased', 'unbiased']
+    if rng is None:
+        rng = onp.random.default_rng()
+    if isinstance(null_samples, list):
+        lst_rng = [r for num, r in zip(null_samples, rng) for _ in range(num)]
+        null_samples = len(lst_rng)
+    else:
+        lst_rng = [rng] * null_samples
+    n_X, n_Y = gram.n_X, gram.n_Y
+    N = n_X + n_Y
+    row_sums = gram.row_sums
+    total = row_sums.sum()
+    trace = gram.diag.sum()
+    chunk_size = max(1, int(PAIRWISE_MAX_BYTES // (8 * N)))
+    null_distr = onp.empty(null_samples)
+    for start in range(0, null_samples, chunk_size):
+        end = min(start + chunk_size, null_samples)
+        A = onp.zeros([N, end - start])
+        r_X = onp.empty(end - start)
+        trace_XX = onp.empty(end - start)
+        for c in range(end - start):
+            ind = lst_rng[start + c].permutation(N)[:n_X]
+            A[ind, c] = 1.
+            # Per permutation, so that the result doesn't depend on how the permutations are chunked
+            r_X[c] = row_sums[ind].sum()
+            trace_XX[c] = gram.diag[ind].sum()
+        sum_XX = gram.quadratic_forms(A)
+        sum_XY = r_X - sum_XX
+        sum_YY = total - 2.*r_X + sum_XX
+        if mmd_type == 'unbiased':
+            null_distr[start:end] = mmdFromSums(n_X, n_Y, sum_XX, sum_YY, sum_XY, trace_XX, trace - trace_XX)
+        else:
+            null_distr[start:end] = mmdFromSums(n_X, n_Y, sum_XX, sum_YY, sum_XY)
+    return null_distr
+
+def _mmdNullChunk(num, rng, gram, mmd_type):
+    return mmdPermutationNull(gram, num, mmd_type=mmd_type, rng=rng)
+
+def _mmdNullChunks(lst_num, lst_rng, gram, mmd_type):
+    return mmdPermutationNull(gram, lst_num, mmd_type=mmd_type, rng=lst_rng)
+
+def mmd_u(K_XX=None, K_YY=None, K_XY=None, normalize=True, gram=None):
     '''
-    Generate (squared) Quadratic Time MMD u-statistic from kernel matrices
+    Generate (squared) Quadratic Time MMD u-statistic from kernel matrices, or from the block sums of the `pooled_gram_matrix` `gram`
     '''
+    if gram is not None:
+        return mmdFromSums(gram.n_X, gram.n_Y, gram.sum_XX, gram.sum_YY, gram.sum_XY, gram.trace_XX, gram.trace_YY, normalize=normalize)
     assert K_XY.shape[0] == K_XY.shape[1]
     m, n = K_XY.shape
     if normalize == True:
@@ -566,76 +1979,239 @@ def mmd_u(K_XX, K_YY, K_XY, normalize=True):
         z = 1.
     return z*(1./(m*(m-1)) * (K_XX.sum() - onp.diag(K_XX).sum()) + 1./(n*(n-1)) * (K_YY.sum() - onp.diag(K_YY).sum()) - 2.*K_XY.mean())
 
-def mmd_l(X, Y, f_kernel, return_2nd_moment=False):
+def mmd_l(X, Y, f_kernel=None, return_2nd_moment=False, f_kernel_pairs=None):
     '''
     Generate (squared) Linear Time MMD u-statistic from samples `X` and `Y` given kernel function `f_kernel`
+    If given, the batched kernel function `f_kernel_pairs` (e.g. `kernel.f_kernel_pairs`), returning k(a_i, b_i) for the matching rows of two samples, is used instead
     '''
     assert X.shape == Y.shape
     n, p = X.shape
+    if f_kernel_pairs is None:
+        f_kernel_pairs = lambda A, B: onp.array([f_kernel(a, b) for a, b in zip(A, B)])
 
-    h = lambda x_i, y_i, x_j, y_j: f_kernel(x_i, x_j) + f_kernel(y_i, y_j) - f_kernel(x_i, y_j) - f_kernel(x_j, y_i)
-
-    n_2 = int(n/2)
-    stat = 0
-    second = 0
-    for i in range(n_2):
-        h_i = h(x_i=X[2*i, :], y_i=Y[2*i, :], x_j=X[2*i+1, :], y_j=Y[2*i+1, :])
-        stat += h_i
-        second += h_i**2
-    stat /= n_2
-    second /= n_2
+    h = mmdLinearTerms(X, Y, f_kernel_pairs)
+    stat = h.mean()
+    second = (h**2).mean()
 
     if return_2nd_moment == True:
         return stat, second
     else:
         return stat
 
+def mmdLinearTerms(X, Y, f_kernel_pairs):
+    '''
+    Linear time MMD h-statistics k(x_i, x_j) + k(y_i, y_j) - k(x_i, y_j) - k(x_j, y_i) of the consecutive pairs of rows (i, j) = (2m, 2m+1) of `X` and `Y`
+    '''
+    n_2 = int(X.shape[0]/2)
+    X_i, X_j = X[0:(2*n_2):2, :], X[1:(2*n_2):2, :]
+    Y_i, Y_j = Y[0:(2*n_2):2, :], Y[1:(2*n_2):2, :]
+    return f_kernel_pairs(X_i, X_j) + f_kernel_pairs(Y_i, Y_j) - f_kernel_pairs(X_i, Y_j) - f_kernel_pairs(X_j, Y_i)
+
+def mmdBlockTerms(X, Y, f_kernel_pairs, block_size):
+    '''
+    Unbiased (squared) MMD of each block of `block_size` consecutive rows of `X` and `Y` (the B-test statistics of Zaremba et al. 2013)
+    Kernel values of all pairs within a block are evaluated with `f_kernel_pairs`, over groups of blocks of about `PAIRWISE_MAX_BYTES`
+    '''
+    B = int(block_size)
+    num_blocks = int(X.shape[0]/B)
+    I, J = onp.triu_indices(B, 1)
+    I_XY, J_XY = onp.divmod(onp.arange(B*B), B)
+    blocks_per_group = max(1, int(PAIRWISE_MAX_BYTES // (8 * B*B * max(X.shape[1], 1))))
+    out = onp.empty(num_blocks)
+    for start in range(0, num_blocks, blocks_per_group):
+        end = min(start + blocks_per_group, num_blocks)
+        offsets = (onp.arange(start, end) * B).reshape(-1, 1)
+        ind_i, ind_j = (offsets + I).reshape(-1), (offsets + J).reshape(-1)
+        S_XX = f_kernel_pairs(X[ind_i], X[ind_j]).reshape(end - start, -1).sum(axis=1)
+        S_YY = f_kernel_pairs(Y[ind_i], Y[ind_j]).reshape(end - start, -1).sum(axis=1)
+        S_XY = f_kernel_pairs(X[(offsets + I_XY).reshape(-1)], Y[(offsets + J_XY).reshape(-1)]).reshape(end - start, -1).sum(axis=1)
+        out[start:end] = 2.*(S_XX + S_YY)/(B*(B-1)) - 2.*S_XY/(B*B)
+    return out
+
+class mmd_accumulator(object):
+    def __init__(self, K, mmd_type='linear', block_size=32):
+        '''
+        Streaming MMD test on two streams of samples, in memory independent of the sample size apart from the buffered rows (see `buffered`)
+        `K` is a kernel object with learned parameters, evaluated on new rows with `f_kernel_pairs`
+        `mmd_type`='linear' averages the linear time MMD h-statistics of consecutive pairs of rows (see `mmd_l`); 'block' averages the unbiased MMD of disjoint blocks of `block_size` rows (an incomplete U-statistic), at O(n * `block_size`) cost
+        Rows of one sample without a counterpart in the other are buffered until it catches up
+        '''
+        assert mmd_type in ['linear', 'block']
+        if mmd_type == 'block':
+            assert block_size >= 2
+        self._K = K
+        self._mmd_type = mmd_type
+        self._unit = 2 if mmd_type == 'linear' else int(block_size)
+        self._buffer_X = None
+        self._buffer_Y = None
+        self._moments = running_moments()
+        pass
+
+    @property
+    def n(self):
+        '''
+        Number of rows of each sample used so far
+        '''
+        return self._moments.n * self._unit
+
+    @property
+    def buffered(self):
+        '''
+        Numbers of rows of each sample waiting for a counterpart in the other
+        '''
+        n_X = 0 if self._buffer_X is None else self._buffer_X.shape[0]
+        n_Y = 0 if self._buffer_Y is None else self._buffer_Y.shape[0]
+        return n_X, n_Y
+
+    def update(self, X=None, Y=None):
+        '''
+        Add rows `X` of the first sample and/or rows `Y` of the second
+        '''
+        if X is not None:
+            X = onp.asarray(X)
+            self._buffer_X = X if self._buffer_X is None else onp.vstack([self._buffer_X, X])
+        if Y is not None:
+            Y = onp.asarray(Y)
+            self._buffer_Y = Y if self._buffer_Y is None else onp.vstack([self._buffer_Y, Y])
+        if self._buffer_X is None or self._buffer_Y is None:
+            return self
+        n = (min(self._buffer_X.shape[0], self._buffer_Y.shape[0]) // self._unit) * self._unit
+        if n > 0:
+            X, Y = self._buffer_X[:n], self._buffer_Y[:n]
+            if self._mmd_type == 'linear':
+                terms = mmdLinearTerms(X, Y, self._K.f_kernel_pairs)
+            else:
+                terms = mmdBlockTerms(X, Y, self._K.f_kernel_pairs, self._unit)
+            self._moments.update(terms)
+            self._buffer_X = self._buffer_X[n:]
+            self._buffer_Y = self._buffer_Y[n:]
+        return self
+
+    def test(self, alpha=0.05):
+        '''
+        Asymptotically normal test on the terms added so far. Same output as `mmd_test`
+        '''
+        assert self._moments.n >= 2
+        test_statistic = self._moments.mean[0]
+        scale = onp.sqrt(self._moments.var[0]/self._moments.n)
+        p_value = scipy.stats.norm.sf(test_statistic, scale=scale)
+        result = p_value <= alpha
+        threshold = scipy.stats.norm.ppf(1.-alpha, scale=scale)
+        return {'result':result, 'p_value':p_value, 'test_statistic':test_statistic, 'critical_value':threshold, 'kernel_param':self._K.params}
+
+def mmd_test_chunked(chunks_X, chunks_Y, kernel=rbf_kernel, alpha=0.05, mmd_type='linear', block_size=32, kernel_learn_method=None, test_functions=None, **kwargs):
+    '''
+    Linear time or block MMD test (see `mmd_accumulator`) on two streams of (n x p) arrays, e.g. from `model.iter_mc` and `model.iter_bc`, in memory independent of the sample size
+    The kernel is learned on the pooled first chunks. `test_functions` is optionally applied to each chunk
+    Chunks are drawn from whichever stream is behind, so at most about one chunk is buffered, and the longer stream is not consumed past the end of the shorter one
+    '''
+    assert kernel_learn_method is None or kernel_learn_method in ['median_heuristic']
+    if kernel_learn_method is None and issubclass(kernel, rbf_kernel):
+        kernel_learn_method = 'median_heuristic'
+    if test_functions is None:
+        test_functions = lambda x: x
+    chunks_X = iter(chunks_X)
+    chunks_Y = iter(chunks_Y)
+    X_0 = test_functions(next(chunks_X))
+    Y_0 = test_functions(next(chunks_Y))
+    XY_0 = onp.vstack([X_0, Y_0])
+    K = kernel(XY_0, XY_0, **kwargs)
+    if issubclass(kernel, rbf_kernel):
+        K.learn(method=kernel_learn_method)
+    else:
+        K.learn()
+    acc = mmd_accumulator(K, mmd_type=mmd_type, block_size=block_size).update(X_0, Y_0)
+    while True:
+        n_X, n_Y = acc.buffered
+        if n_X <= n_Y:
+            X = next(chunks_X, None)
+            if X is None:
+                break
+            acc.update(X=test_functions(X))
+        else:
+            Y = next(chunks_Y, None)
+            if Y is None:
+                break
+            acc.update(Y=test_functions(Y))
+    return acc.test(alpha=alpha)
+
 #######################################################################
 ############################ Wild MMD test ############################
 #######################################################################
 
-def wb_process(n, k=1, l_n=20, center=False, rng=None):
+def wb_process(n, k=1, l_n=20, center=False, rng=None, chain_ids=None):
     '''
     Generate `k` wild bootstrap processes of length `n` for the Wild MMD test. Returns an (n x k) matrix
+    The AR(1) recursion W_i = exp(-1/l_n) W_(i-1) + sqrt(1-exp(-2/l_n)) epsilon_i is applied to all processes at once as a linear filter
+    If `chain_ids` is given, the processes restart (independently) at the first row of each chain
     '''
     if rng is None:
         rng = onp.random.default_rng()
     epsilon = rng.normal(size=(n, k))
     W = onp.sqrt(1-onp.exp(-2/l_n)) * epsilon
     
-    for i in range(1, n):
-        W[i, :] += W[i-1, :] * onp.exp(-1/l_n)
+    starts = [0]
+    if chain_ids is not None:
+        chain_ids = onp.asarray(chain_ids)
+        starts += list(onp.flatnonzero(chain_ids[1:] != chain_ids[:-1]) + 1)
+    for start, end in zip(starts, starts[1:] + [n]):
+        W[start:end, :] = scipy.signal.lfilter([1.], [1., -onp.exp(-1/l_n)], W[start:end, :], axis=0)
 
     if center==True:
         W -= W.mean(0).reshape(1, k)
     return W
 
-def mmd_wb(K_XX, K_YY, K_XY, normalize=True, wb_l_n=20, wb_center=False, rng=None):
+def mmd_wb(K_XX=None, K_YY=None, K_XY=None, normalize=True, wb_l_n=20, wb_center=False, rng=None, chain_ids=None, gram=None, W=None, H=None):
     '''
-    Generate wild bootstrapped MMD v-statistic for the Wild MMD test using kernel matrices
+    Generate wild bootstrapped MMD v-statistic for the Wild MMD test using kernel matrices, or the blocks of the `pooled_gram_matrix` `gram`
     `normalize`=True will return the normalized bootstrapped statistics
+    `chain_ids` gives the chain of each row of Y when it comes from several independent chains
+    `W` optionally gives the wild bootstrap processes (see `wbProcesses`) instead of drawing one with `rng`; if the sample sizes differ, its first n_X rows are the processes of X and the rest those of Y. An (n x k) matrix `W` returns the k bootstrapped statistics at once
+    For equal sample sizes n, the statistics are the quadratic forms w'Hw/n^2 of H = K_XX + K_YY - 2 K_XY, formed once (or given as `H`, see `pooled_gram_matrix.combined`), so k statistics take one matrix product H W
+    Otherwise they are the quadratic forms v'Kv of the pooled matrix with v = [w_X/n_X; -w_Y/n_Y], again for all columns at once
     '''
     if rng is None:
         rng = onp.random.default_rng()
-    n_X, n_Y = K_XY.shape
+    single = W is None or len(W.shape) == 1
+    if gram is not None:
+        n_X, n_Y = gram.n_X, gram.n_Y
+    elif H is not None:
+        n_X = n_Y = H.shape[0]
+    else:
+        n_X, n_Y = K_XY.shape
     z = 1.
-    if n_X == n_Y:
-        if normalize == True:
-            z = n_X
-        W = wb_process(n_X, l_n=wb_l_n, center=wb_center, rng=rng).reshape(-1, 1)
-        return z*(W.T @ (K_XX + K_YY - 2*K_XY) @ W)/(n_X**2)
+    if normalize == True:
+        z = n_X if n_X == n_Y else n_X * n_Y / (n_X + n_Y)
+    if W is None:
+        W = wbProcesses(n_X, n_Y, 1, l_n=wb_l_n, center=wb_center, rng=rng, chain_ids=chain_ids)
+    W = W.reshape(W.shape[0], -1)
+
+    if n_X == n_Y and (H is not None or gram is None):
+        if H is None:
+            H = K_XX + K_YY - 2*K_XY
+        W = onp.asarray(W, dtype=onp.result_type(H, onp.float32))
+        out = z*(W * (H @ W)).sum(axis=0, dtype=onp.float64)/(n_X**2)
     else:
-        w_X = wb_process(n_X, l_n=wb_l_n, center=wb_center, rng=rng).reshape(-1, 1)
-        w_Y = wb_process(n_Y, l_n=wb_l_n, center=wb_center, rng=rng).reshape(-1, 1)
-        if normalize == True:
-            z = n_X * n_Y / (n_X + n_Y)
-        return z*(1./n_X**2 * w_X.T @ K_XX @ w_X + 1./n_Y**2 * w_Y.T @ K_YY @ w_Y - 2./(n_X*n_Y) * w_X.T @ K_XY @ w_Y) 
+        if n_X == n_Y:
+            v = onp.vstack([W, -W])/n_X
+        else:
+            v = onp.vstack([W[:n_X]/n_X, -W[n_X:]/n_Y])
+        if gram is not None:
+            out = z*gram.quadratic_forms(v)
+        else:
+            v_X, v_Y = v[:n_X], v[n_X:]
+            out = z*((v_X * (K_XX @ v_X + K_XY @ v_Y)).sum(axis=0) + (v_Y * (K_XY.T @ v_X + K_YY @ v_Y)).sum(axis=0))
+    if single == True:
+        return float(out[0])
+    return out
 
-def mmd_v(K_XX, K_YY, K_XY, normalize=True):
+def mmd_v(K_XX=None, K_YY=None, K_XY=None, normalize=True, gram=None):
     '''
-    Generate (squared) MMD v-statistic for the Wild MMD test
+    Generate (squared) MMD v-statistic for the Wild MMD test, from kernel matrices or the block sums of the `pooled_gram_matrix` `gram`
     `normalize`=True will return the normalized statistic
     '''
+    if gram is not None:
+        return mmdFromSums(gram.n_X, gram.n_Y, gram.sum_XX, gram.sum_YY, gram.sum_XY, normalize=normalize)
     n_X, n_Y = K_XY.shape
     z = 1.
     if n_X == n_Y:
@@ -646,10 +2222,18 @@ def mmd_v(K_XX, K_YY, K_XY, normalize=True):
             z = n_X * n_Y / (n_X + n_Y)
     return z*(K_XX.mean() + K_YY.mean() - 2.*K_XY.mean())
 
-def mmd_wb_test(X, Y, kernel=rbf_kernel, alpha=0.05, null_samples=100, kernel_learn_method=None, wb_l_n=20, wb_center=False, rng=None, **kwargs):
+def mmd_wb_test(X, Y, kernel=rbf_kernel, alpha=0.05, null_samples=100, kernel_learn_method=None, wb_l_n=20, wb_center=False, rng=None, chain_ids_Y=None, executor=None, null_chunk_size=None, nystroem_landmarks=None, nystroem_method='uniform', gram_storage='memory', gram_dir=None, dtype=None, **kwargs):
     '''
     Run Wild MMD test on samples with shape (n x p)
+    `chain_ids_Y` gives the chain of each row of `Y` when it comes from several independent chains (see `model_sampler.sample_sc`)
+    The bootstrap replicates are computed in chunks of `null_chunk_size` (default `MAP_CHUNK_SIZE`) with their own seeds, in parallel on `executor` if given (see `mapChunks`); without an executor, all chunks take one matrix product
+    If `nystroem_landmarks` is given, uses a Nystrom approximation of the kernel matrix in O(n `nystroem_landmarks`) (see `kernel.nystroem_features`), with the median heuristic on a random subset of pairs as in `mmd_test`
+    `gram_storage`='memmap' keeps the exact kernel matrix in a memory-mapped file in `gram_dir` (see `pooled_gram_matrix`), also with the median heuristic on a random subset of pairs
+    `dtype`='float32' computes and stores the kernel matrix in single precision, as in `mmd_test`
+    Lazy test function views are materialized
     '''
+    X = onp.asarray(X)
+    Y = onp.asarray(Y)
     if len(X.shape) == 1:
         X = X.reshape(X.shape[0], 1)
     if len(Y.shape) == 1:
@@ -657,12 +2241,18 @@ def mmd_wb_test(X, Y, kernel=rbf_kernel, alpha=0.05, null_samples=100, kernel_le
     if rng is None:
         rng = onp.random.default_rng()
     assert kernel_learn_method is None or kernel_learn_method in ['median_heuristic']
-    if kernel_learn_method is None and (kernel == rbf_kernel):
+    if kernel_learn_method is None and issubclass(kernel, rbf_kernel):
         kernel_learn_method = 'median_heuristic'    
+    if dtype is not None:
+        X = X.astype(dtype, copy=False)
+        Y = Y.astype(dtype, copy=False)
+        kwargs['dtype'] = dtype
+    if nystroem_landmarks is not None or gram_storage == 'memmap':
+        kwargs = subsampledMedianKwargs(kernel, kwargs)
     
     XY = onp.vstack([X, Y])
     K = kernel(XY, XY, **kwargs)
-    if kernel in [rbf_kernel]:
+    if issubclass(kernel, rbf_kernel):
         K.learn(method=kernel_learn_method)
     elif kernel == linear_kernel:
         pass
@@ -673,49 +2263,85 @@ def mmd_wb_test(X, Y, kernel=rbf_kernel, alpha=0.05, null_samples=100, kernel_le
     n_X, p = X.shape
     n_Y = Y.shape[0]
     
-    K_XYXY = K.eval()
-    K_XX = K_XYXY[:n_X, :][:, :n_X]
-    K_YY = K_XYXY[n_X:, :][:, n_X:]
-    K_XY = K_XYXY[:n_X, :][:, n_X:]
-
-    B = onp.empty(null_samples)
-    for i in range(null_samples):
-        B[i] = mmd_wb(K_XX, K_YY, K_XY, normalize=True, wb_l_n=wb_l_n, wb_center=wb_center, rng=rng)
+    gram = gramMatrix(K, XY, n_X, nystroem_landmarks=nystroem_landmarks, nystroem_method=nystroem_method, rng=rng, storage=gram_storage, storage_dir=gram_dir, dtype=dtype)
+
+    try:
+        # For equal sample sizes, the bootstrap uses the (n x n) matrix H instead of the (2n x 2n) pooled matrix, unless the kernel matrix is low rank or out of core
+        H = None
+        if n_X == n_Y and isinstance(gram, lowrank_gram_matrix) == False and gram_storage == 'memory':
+            H = gram.combined()
+        B = mapChunks(_mmdWildNullChunk, null_samples, null_chunk_size, rng, args=(gram, wb_l_n, wb_center, chain_ids_Y, H), executor=executor, f_stacked=_mmdWildNullChunks)
+        test_statistic = mmd_v(normalize=True, gram=gram)
+    finally:
+        gram.close()
 
     threshold = onp.quantile(B, 1.-alpha)
-    test_statistic = mmd_v(K_XX, K_YY, K_XY, normalize=True)
     result = test_statistic >= threshold
     p_value = (B >= test_statistic).mean() # one-sided
     
     return {'result':result, 'p_value':p_value, 'test_statistic':test_statistic, 'critical_value':threshold, 'kernel_param':K.params}
 
-def mmd_var(K_XX, K_XY, K_YY):
+def wbProcesses(n_X, n_Y, k, l_n=20, center=False, rng=None, chain_ids=None):
     '''
-    Estimate MMD variance. From Sutherland et al. 2016
+    `k` wild bootstrap processes for samples of sizes `n_X` and `n_Y` as used by `mmd_wb`: an (n_X x k) matrix if the sizes are equal, else an ((n_X+n_Y) x k) matrix stacking independent processes for X and Y
     '''
-    m = K_XX.shape[0]
+    if n_X == n_Y:
+        return wb_process(n_X, k, l_n=l_n, center=center, rng=rng, chain_ids=chain_ids)
+    W_X = wb_process(n_X, k, l_n=l_n, center=center, rng=rng)
+    W_Y = wb_process(n_Y, k, l_n=l_n, center=center, rng=rng, chain_ids=chain_ids)
+    return onp.vstack([W_X, W_Y])
+
+def _mmdWildNullChunk(num, rng, gram, wb_l_n, wb_center, chain_ids, H=None):
+    W = wbProcesses(gram.n_X, gram.n_Y, num, l_n=wb_l_n, center=wb_center, rng=rng, chain_ids=chain_ids)
+    return mmd_wb(normalize=True, gram=gram, W=W, H=H)
+
+def _mmdWildNullChunks(lst_num, lst_rng, gram, wb_l_n, wb_center, chain_ids, H=None):
+    W = onp.hstack([wbProcesses(gram.n_X, gram.n_Y, num, l_n=wb_l_n, center=wb_center, rng=rng, chain_ids=chain_ids) for num, rng in zip(lst_num, lst_rng)])
+    return mmd_wb(normalize=True, gram=gram, W=W, H=H)
 
-    diag_X = onp.diag(K_XX)
-    diag_Y = onp.diag(K_YY)
+def mmd_dtype_check(X, Y, test=mmd_test, dtype='float32', seed=0, **kwargs):
+    '''
+    Accuracy check of a reduced precision MMD test against the double precision one: runs `test` (`mmd_test` or `mmd_wb_test`) on `X` and `Y` with **kwargs, once in double precision and once in `dtype`, with the same random numbers (from `seed`)
+    Returns the absolute differences of the test statistic, p-value and critical value, and whether the results agree
+    With float32 the (normalized) statistic and critical value typically differ by 1e-7 to 1e-5, so p-values only change when the statistic is that close to a null replicate
+    '''
+    out_64 = test(X, Y, rng=onp.random.default_rng(seed), **kwargs)
+    out_lo = test(X, Y, rng=onp.random.default_rng(seed), dtype=dtype, **kwargs)
+    return {'test_statistic':abs(out_lo['test_statistic'] - out_64['test_statistic']), 'p_value':abs(out_lo['p_value'] - out_64['p_value']), 'critical_value':abs(out_lo['critical_value'] - out_64['critical_value']), 'result':out_lo['result'] == out_64['result']}
 
-    sum_diag_X = diag_X.sum()
-    sum_diag_Y = diag_Y.sum()
+def mmd_var(K_XX=None, K_XY=None, K_YY=None, gram=None):
+    '''
+    Estimate MMD variance. From Sutherland et al. 2016
+    Uses the precomputed sums of the `pooled_gram_matrix` `gram` if given
+    '''
+    if gram is not None:
+        m = gram.n_X
+        diag_X = gram.diag[:m]
+        diag_Y = gram.diag[m:]
+        Kt_XX_sums = gram.row_sums_XX - diag_X
+        Kt_YY_sums = gram.row_sums_YY - diag_Y
+        K_XY_sums_0 = gram.col_sums_XY
+        K_XY_sums_1 = gram.row_sums_XY
+        K_XX_2_sum, K_YY_2_sum, K_XY_2_sum = gram.sq_sum_XX, gram.sq_sum_YY, gram.sq_sum_XY
+    else:
+        m = K_XX.shape[0]
+        diag_X = onp.diag(K_XX)
+        diag_Y = onp.diag(K_YY)
+        Kt_XX_sums = K_XX.sum(axis=1) - diag_X
+        Kt_YY_sums = K_YY.sum(axis=1) - diag_Y
+        K_XY_sums_0 = K_XY.sum(axis=0)
+        K_XY_sums_1 = K_XY.sum(axis=1)
+        K_XX_2_sum, K_YY_2_sum, K_XY_2_sum = (K_XX ** 2).sum(), (K_YY ** 2).sum(), (K_XY ** 2).sum()
 
     sum_diag2_X = diag_X.dot(diag_X)
     sum_diag2_Y = diag_Y.dot(diag_Y)
 
-    Kt_XX_sums = K_XX.sum(axis=1) - diag_X
-    Kt_YY_sums = K_YY.sum(axis=1) - diag_Y
-    K_XY_sums_0 = K_XY.sum(axis=0)
-    K_XY_sums_1 = K_XY.sum(axis=1)
-
     Kt_XX_sum = Kt_XX_sums.sum()
     Kt_YY_sum = Kt_YY_sums.sum()
     K_XY_sum = K_XY_sums_0.sum()
 
-    Kt_XX_2_sum = (K_XX ** 2).sum() - sum_diag2_X
-    Kt_YY_2_sum = (K_YY ** 2).sum() - sum_diag2_Y
-    K_XY_2_sum  = (K_XY ** 2).sum()
+    Kt_XX_2_sum = K_XX_2_sum - sum_diag2_X
+    Kt_YY_2_sum = K_YY_2_sum - sum_diag2_Y
 
     var_est = (
           2 / (m**2 * (m-1)**2) * (
@@ -743,33 +2369,110 @@ def ks_test(X, Y, alpha=0.05, test_correction='bh'):
     '''
     Exact two-sample Kolmogorov-Smirnov test from Gandy and Scott 2020
     `test_correction` corrects for multiple testing if set to 'b' (for Bonferroni) or 'bh' (for Benjamini-Hochberg)
+    `X` and `Y` can be lazy test function views (see `model_sampler.test_functions` and `iterPairedColumnBlocks`)
     '''
     assert len(X.shape) == 2
     assert len(Y.shape) == 2
     assert X.shape[1] == Y.shape[1]
     
     assert test_correction in ['b', 'bh']
-    num_tests = X.shape[1]
-    
-    p_value = onp.array([scipy.stats.ks_2samp(X[:, j], Y[:, j]).pvalue for j in range(X.shape[1])])
     
-    if test_correction == 'b':
-        threshold = scipy.stats.norm.ppf(1.-alpha/(2.)) # asymptotic
-        alpha /= num_tests
-        result = p_value <= alpha
-    elif test_correction == 'bh':
-        threshold = None
-        rank = onp.empty_like(p_value)
-        rank[onp.argsort(p_value)] = onp.arange(1, len(p_value)+1)
-        under = p_value <= rank/num_tests * alpha
-        if under.sum() > 0:
-          rank_max = rank[under].max()
-        else:
-          rank_max = 0
-        result = rank <= rank_max
+    p_value = []
+    for X_block, Y_block in iterPairedColumnBlocks(X, Y):
+        p_value += [scipy.stats.ks_2samp(X_block[:, j], Y_block[:, j]).pvalue for j in range(X_block.shape[1])]
+    p_value = onp.array(p_value)
+    result, threshold = multipleTestCorrection(p_value, alpha, test_correction)
     
     return {'result': result, 'p_value': p_value}
 
+class ks_sketch(object):
+    def __init__(self, edges):
+        '''
+        Mergeable sketch of the column-wise empirical CDFs of a stream of (n x p) arrays, binned at fixed `edges`
+        `edges` is a (num_edges x p) array of increasing bin edges, one column per feature (see `ks_sketch_edges`)
+        '''
+        self._edges = edges
+        self._counts = onp.zeros(edges.shape, dtype='int64')
+        self._n = 0
+        pass
+
+    @property
+    def n(self):
+        return self._n
+
+    @property
+    def edges(self):
+        return self._edges
+
+    @property
+    def cdf(self):
+        '''
+        Empirical CDF evaluated at the bin edges
+        '''
+        return self._counts.cumsum(axis=0)/float(self._n)
+
+    def update(self, x):
+        '''
+        Add the rows of `x`
+        '''
+        assert len(x.shape) == 2 and x.shape[1] == self._edges.shape[1]
+        num_edges = self._edges.shape[0]
+        for j in range(x.shape[1]):
+            # Count of x <= edge, binned at the smallest edge above each value; values above the last edge only enter `n`
+            ind = onp.searchsorted(self._edges[:, j], x[:, j], side='left')
+            self._counts[:, j] += onp.bincount(ind[ind < num_edges], minlength=num_edges)
+        self._n += x.shape[0]
+        return self
+
+    def merge(self, other):
+        '''
+        Add the counts of the `ks_sketch` object `other`, which must share the same edges
+        '''
+        assert onp.array_equal(self._edges, other.edges)
+        self._counts += other._counts
+        self._n += other.n
+        return self
+
+def ks_sketch_edges(X, num_bins=1000):
+    '''
+    Bin edges for `ks_sketch` given by the empirical quantiles of each column of the pilot sample `X`
+    '''
+    return onp.quantile(X, onp.linspace(0., 1., num_bins+1), axis=0)
+
+def ks_sketch_test(sketch_X, sketch_Y, alpha=0.05, test_correction='bh'):
+    '''
+    Asymptotic two-sample Kolmogorov-Smirnov test on a pair of `ks_sketch` objects with the same edges
+    The statistic is the largest CDF difference over the bin edges, so it never exceeds the exact statistic (the test is conservative)
+    `test_correction` corrects for multiple testing if set to 'b' (for Bonferroni) or 'bh' (for Benjamini-Hochberg)
+    '''
+    assert onp.array_equal(sketch_X.edges, sketch_Y.edges)
+    assert test_correction in ['b', 'bh']
+    n_X, n_Y = sketch_X.n, sketch_Y.n
+    test_statistic = abs(sketch_X.cdf - sketch_Y.cdf).max(axis=0)
+    p_value = scipy.stats.kstwobign.sf(onp.sqrt(n_X*n_Y/(n_X+n_Y)) * test_statistic)
+    result, threshold = multipleTestCorrection(p_value, alpha, test_correction)
+    return {'result': result, 'p_value': p_value, 'test_statistic': test_statistic}
+
+def ks_test_chunked(chunks_X, chunks_Y, alpha=0.05, test_correction='bh', num_bins=1000, test_functions=None):
+    '''
+    Two-sample Kolmogorov-Smirnov test on two streams of (n x p) arrays, e.g. from `model.iter_mc` and `model.iter_bc`, in memory independent of the sample size
+    The bin edges are taken from the pooled first chunks. `test_functions` is optionally applied to each chunk
+    '''
+    if test_functions is None:
+        test_functions = lambda x: x
+    chunks_X = iter(chunks_X)
+    chunks_Y = iter(chunks_Y)
+    X_0 = test_functions(next(chunks_X))
+    Y_0 = test_functions(next(chunks_Y))
+    edges = ks_sketch_edges(onp.vstack([X_0, Y_0]), num_bins=num_bins)
+    sketch_X = ks_sketch(edges).update(X_0)
+    sketch_Y = ks_sketch(edges).update(Y_0)
+    for X in chunks_X:
+        sketch_X.update(test_functions(X))
+    for Y in chunks_Y:
+        sketch_Y.update(test_functions(Y))
+    return ks_sketch_test(sketch_X, sketch_Y, alpha=alpha, test_correction=test_correction)
+
 def rank_stat(model, L, test_functions=None, rng=None):
     '''
     Generate Rank statistic from Gandy and Scott 2020 using a chain of length `L` sampled from `model`
@@ -782,32 +2485,37 @@ def rank_stat(model, L, test_functions=None, rng=None):
     M = rng.choice(L)
 
     chain = onp.zeros(shape=(L, len(model.theta_indices)))
-    chain[M, :] = model.drawPrior()
+    chain[M, :] = model.drawPrior(rng)
 
-    y = model.drawLikelihood()
+    y = model.drawLikelihood(rng)
     
     stateDict = model.__dict__.copy()
 
     # Backward
     for i in range(M-1, -1, -1):
-        chain[i, :] = model.drawPosterior()
+        chain[i, :] = model.drawPosterior(rng)
 
     # Forward
     model.__dict__ = stateDict.copy()
     for j in range(M+1, L):
-        chain[j, :] = model.drawPosterior()
+        chain[j, :] = model.drawPosterior(rng)
     
     # Apply test functions
     chain = onp.hstack([onp.repeat(y.reshape(1, model._N*model._D), repeats=L, axis=0), chain])
     chain = test_functions(chain)
     return scipy.stats.rankdata(chain, 'ordinal', axis = 0)[M, :]
 
-def rank_test(model, N, L, alpha=0.05, test_functions=None, test_correction='bh', rng=None):
+def _rankStatChunk(num, rng, model, L, test_functions):
+    model = copy.deepcopy(model)
+    return onp.vstack([rank_stat(model=model, L=L, test_functions=test_functions, rng=rng) for _ in range(num)])
+
+def rank_test(model, N, L, alpha=0.05, test_functions=None, test_correction='bh', rng=None, executor=None, chunk_size=50):
     '''
     Rank test from Gandy and Scott 2020
     `N` = number of Rank statistics to compute
     `L` = length of each Rank statistic's chain
     `test_correction` corrects for multiple testing if set to 'b' (for Bonferroni) or 'bh' (for Benjamini-Hochberg)
+    The statistics are computed in chunks of `chunk_size`, each on its own copy of `model`, optionally in parallel on `executor` (see `mapChunks`)
     ''' 
     if rng is None:
         rng = model._rng_s
@@ -816,7 +2524,7 @@ def rank_test(model, N, L, alpha=0.05, test_functions=None, test_correction='bh'
     if test_correction is not None:
         assert test_correction in ['b', 'bh']
         
-    ranks = onp.vstack([rank_stat(model=model, L=L, test_functions=test_functions) for _ in range(N)])
+    ranks = mapChunks(_rankStatChunk, N, chunk_size, rng, args=(model, L, test_functions), executor=executor)
     f_obs = onp.apply_along_axis(lambda x: onp.bincount(x, minlength=L), axis=0, arr=ranks-1)
     p_value = onp.array([scipy.stats.chisquare(f_obs[:, j]).pvalue for j in range(ranks.shape[1])])
 
@@ -835,10 +2543,11 @@ def rank_test(model, N, L, alpha=0.05, test_functions=None, test_correction='bh'
       
     return {'result': result, 'p_value': p_value}  
 
-def f_test_sequential(sample_size, model, test_type, **kwargs):
+def f_test_sequential(sample_size, model, test_type, sc_multi_chain=False, **kwargs):
     '''
     Helper function for the sequential test from Gandy and Scott 2020
     Returns p-values from a `test_type` test using samples generated from `model`
+    If `sc_multi_chain`=True, the successive-conditional samples come from `model._nproc` independent chains run in parallel
     '''
     assert test_type in ['rank', 'ks', 'mmd', 'mmd-wb', 'geweke']
         
@@ -856,13 +2565,25 @@ def f_test_sequential(sample_size, model, test_type, **kwargs):
             mmd_test_size = int(sample_size)
             mmd_thinning = onp.arange(0, int(sample_size), 5)
             X = model.test_functions(model.sample_mc(mmd_test_size))
-            Y = model.test_functions(model.sample_sc(sample_size))
-            p_values = mmd_wb_test(X, Y[mmd_thinning, :])['p_value']
+            if sc_multi_chain == True:
+                samples_sc, chain_ids = model.sample_sc(sample_size, multi_chain=True)
+                Y = model.test_functions(samples_sc)
+                chain_ids = chain_ids[mmd_thinning]
+            else:
+                Y = model.test_functions(model.sample_sc(sample_size))
+                chain_ids = None
+            p_values = mmd_wb_test(X, Y[mmd_thinning, :], chain_ids_Y=chain_ids)['p_value']
         elif test_type == 'geweke':
             geweke_thinning = onp.arange(0, int(sample_size), 5)
             X = model.test_functions(model.sample_mc(sample_size))
-            Y = model.test_functions(model.sample_sc(sample_size))
-            p_values = geweke_test(X, Y[geweke_thinning, :], l=0.08, test_correction='b')['p_value']        
+            if sc_multi_chain == True:
+                samples_sc, chain_ids = model.sample_sc(sample_size, multi_chain=True)
+                Y = model.test_functions(samples_sc)
+                chain_ids = chain_ids[geweke_thinning]
+            else:
+                Y = model.test_functions(model.sample_sc(sample_size))
+                chain_ids = None
+            p_values = geweke_test(X, Y[geweke_thinning, :], l=0.08, test_correction='b', chain_ids_sc=chain_ids)['p_value']        
     return p_values
     
 def sequential_test(f_test, n, alpha, k, Delta):
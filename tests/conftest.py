@@ -0,0 +1,5 @@
+import os
+import sys
+
+# The mcmcmd modules are imported from the repository root, as in the notebooks
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
@@ -0,0 +1,25 @@
+import numpy as onp
+import pytest
+
+from mcmcmd.tests import geweke_se2, geweke_se2_arch
+
+pytest.importorskip('arch')
+
+
+@pytest.mark.parametrize('L', [None, 1, 8])
+@pytest.mark.parametrize('force_int_L', [False, True])
+def test_geweke_se2_matches_arch(L, force_int_L):
+    rng = onp.random.default_rng(0)
+    # AR(1) columns, so that the autocovariances matter
+    e = rng.normal(size=(500, 3))
+    g = onp.empty_like(e)
+    g[0] = e[0]
+    for t in range(1, len(e)):
+        g[t] = onp.array([0., 0.5, 0.9]) * g[t-1] + e[t]
+    assert onp.allclose(geweke_se2(g, L=L, force_int_L=force_int_L), geweke_se2_arch(g, L=L, force_int_L=force_int_L))
+
+
+def test_geweke_se2_arch_single_column():
+    g = onp.random.default_rng(1).normal(size=200)
+    assert geweke_se2_arch(g).shape == (1,)
+    assert onp.allclose(geweke_se2(g), geweke_se2_arch(g))
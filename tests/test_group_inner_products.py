@@ -0,0 +1,26 @@
+import numpy as onp
+import pytest
+
+from mcmcmd.tests import groupInnerProducts, kernel, kernel_cache
+
+
+@pytest.mark.parametrize('cache', [False, True])
+@pytest.mark.parametrize('same', [False, True])
+def test_group_inner_products(cache, same):
+    rng = onp.random.default_rng(0)
+    A = rng.normal(size=(20, 6))
+    B = A if same == True else rng.normal(size=(15, 6))
+    lst_groups = [onp.arange(6), onp.array([4, 5]), onp.array([0, 4]), onp.array([3])]
+    wanted = [True, True, True, False]
+    if cache == True:
+        kernel.set_cache(kernel_cache())
+    try:
+        # Keep every output, so that later groups can't have modified earlier ones
+        out = [None if inner is None else tuple(inner) for inner in groupInnerProducts(lst_groups, A, B, wanted)]
+    finally:
+        kernel.set_cache(None)
+    assert out[3] is None
+    for group, inner in zip(lst_groups[:3], out[:3]):
+        assert onp.allclose(inner[0], A[:, group] @ B[:, group].T)
+        assert onp.allclose(inner[1], (A[:, group]**2).sum(axis=1))
+        assert onp.allclose(inner[2], (B[:, group]**2).sum(axis=1))
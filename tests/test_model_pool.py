@@ -0,0 +1,30 @@
+import gc
+
+from test_null_chunks import gaussian_sum
+
+
+def test_pool_restarts_when_model_changes():
+    model = gaussian_sum(seed=0, nproc=2)
+    try:
+        model.sample_mc(100)
+        pool = model._pool
+        model.sample_mc(100)
+        assert model._pool is pool
+        model._sigma_epsilon = 1000.
+        samples = model.sample_mc(1000)
+        assert model._pool is not pool
+        # The workers sample with the new noise scale
+        assert samples[:, 0].std() > 500.
+    finally:
+        model.close_pool()
+
+
+def test_pool_terminated_with_model():
+    model = gaussian_sum(seed=0, nproc=2)
+    model.sample_mc(100)
+    processes = list(model._pool._pool)
+    del model
+    gc.collect()
+    for p in processes:
+        p.join(timeout=5)
+    assert all([p.is_alive() == False for p in processes])
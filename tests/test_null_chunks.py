@@ -0,0 +1,65 @@
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as onp
+import pytest
+
+from mcmcmd.samplers import model_sampler
+from mcmcmd.tests import mmd_test, mmd_wb_test, rank_test
+
+
+class gaussian_sum(model_sampler):
+    '''
+    Y ~ N(theta_1 + theta_2, sigma_epsilon^2) with independent N(0, sigma^2) priors, sampled with a Gibbs sampler
+    '''
+    def __init__(self, **kwargs):
+        self._N = 1
+        self._D = 1
+        self._sigma = 10.
+        self._sigma_epsilon = onp.sqrt(0.1)
+        super().__init__(**kwargs)
+
+    @property
+    def sample_dim(self):
+        return self._N + 2
+
+    @property
+    def theta_indices(self):
+        return onp.arange(self._N, self.sample_dim)
+
+    def drawPrior(self, rng=None):
+        self._theta = rng.normal(0., self._sigma, size=2)
+        return self._theta.copy()
+
+    def drawLikelihood(self, rng=None):
+        self._y = rng.normal(self._theta.sum(), self._sigma_epsilon, size=self._N)
+        return self._y.copy()
+
+    def drawPosterior(self, rng=None):
+        v = 1./(1./self._sigma**2 + self._N/self._sigma_epsilon**2)
+        for i in range(2):
+            m = v*(self._y - self._theta[1-i]).sum()/self._sigma_epsilon**2
+            self._theta[i] = rng.normal(m, onp.sqrt(v))
+        return self._theta.copy()
+
+
+@pytest.mark.parametrize('test', [mmd_test, mmd_wb_test])
+@pytest.mark.parametrize('null_chunk_size', [None, 1, 7])
+@pytest.mark.parametrize('n_Y', [120, 150])
+def test_mmd_null_independent_of_executor(test, null_chunk_size, n_Y):
+    rng = onp.random.default_rng(0)
+    X, Y = rng.normal(size=(150, 3)), rng.normal(size=(n_Y, 3)) + 0.1
+    serial = test(X, Y, null_samples=120, rng=onp.random.default_rng(1), null_chunk_size=null_chunk_size)
+    with ThreadPoolExecutor(3) as executor:
+        parallel = test(X, Y, null_samples=120, rng=onp.random.default_rng(1), null_chunk_size=null_chunk_size, executor=executor)
+    assert serial['p_value'] == parallel['p_value']
+    # The replicates are the same up to the rounding of matrix products of different widths
+    assert onp.isclose(serial['critical_value'], parallel['critical_value'], rtol=1e-12, atol=0.)
+    assert serial['test_statistic'] == parallel['test_statistic']
+
+
+def test_rank_test_independent_of_executor():
+    model = gaussian_sum(seed=0)
+    serial = rank_test(model, 60, 5, rng=onp.random.default_rng(2), chunk_size=8)
+    with ThreadPoolExecutor(3) as executor:
+        parallel = rank_test(model, 60, 5, rng=onp.random.default_rng(2), chunk_size=8, executor=executor)
+    assert onp.array_equal(serial['p_value'], parallel['p_value'])
@@ -0,0 +1,33 @@
+import numpy as onp
+import pytest
+
+from mcmcmd.tests import pooled_gram_matrix, rbf_kernel
+
+
+@pytest.mark.parametrize('N, n_X, max_bytes', [(3, 1, 800), (37, 12, 800), (200, 90, 20000), (200, 100, None)])
+def test_packed_matches_full(N, n_X, max_bytes):
+    XY = onp.random.default_rng(0).normal(size=(N, 2))
+    K = rbf_kernel(XY, XY)
+    K.learn()
+    packed = pooled_gram_matrix(K, XY, n_X, packed=True, max_bytes=max_bytes)
+    full = pooled_gram_matrix(K, XY, n_X, max_bytes=max_bytes)
+    dense = full.dense
+    assert onp.allclose(packed.dense, dense)
+    assert onp.array_equal(packed.dense, packed.dense.T)
+    for rows, cols in [(slice(0, n_X), slice(n_X, N)), (slice(n_X, N), slice(0, N)), (slice(1, N-1, 2), slice(0, N, 3)), (slice(N, N), slice(0, N))]:
+        assert onp.allclose(packed.block(rows, cols), dense[rows, cols])
+    for rows, R in packed.iter_row_blocks():
+        assert onp.allclose(R, dense[rows, :])
+    for name in ['sum_XX', 'sum_YY', 'sum_XY', 'trace_XX', 'sq_sum_XY']:
+        assert onp.isclose(getattr(packed, name), getattr(full, name))
+
+
+def test_packed_set_dense():
+    XY = onp.random.default_rng(1).normal(size=(50, 2))
+    K = rbf_kernel(XY, XY)
+    K.learn()
+    packed = pooled_gram_matrix(K, XY, 20, packed=True, max_bytes=800)
+    dense = packed.dense
+    packed._data[:] = 0.
+    packed._set_dense(dense)
+    assert onp.array_equal(packed.dense, dense)